@@ -0,0 +1,272 @@
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from gymrun import kg_to_lbs, parse_unit
+import history
+from history import HISTORY_PATH, get_meta, set_meta
+
+# Aggregates over the `entry` table of history.db, advanced by
+# `update_aggregates` from their own high-water mark so each backup only
+# touches the sets it added. Weights are kilograms, as in `entry`.
+# Days and weeks (starting Monday) are local dates, like the card times.
+SCHEMA = """
+create index if not exists entry_time on entry (time, _id);
+create table if not exists exercise_record (
+    exercise integer primary key,
+    max_weight real,
+    max_weight_reps integer,
+    max_weight_time integer,
+    best_e1rm real,
+    best_e1rm_time integer,
+    max_reps integer not null default 0,
+    max_reps_time integer,
+    sets integer not null default 0
+);
+create table if not exists exercise_e1rm (
+    exercise integer not null,
+    day text not null,
+    e1rm real not null,
+    primary key (exercise, day)
+) without rowid;
+create table if not exists weekly_volume (
+    week text not null,
+    exercise integer not null,
+    sets integer not null,
+    reps integer not null,
+    volume real not null,
+    primary key (week, exercise)
+) without rowid;
+create table if not exists weekly_workouts (
+    week text primary key,
+    workouts integer not null,
+    sets integer not null
+) without rowid;
+"""
+
+# Bumped when `fold_new_sets` changes, so aggregates folded the old way are
+# recomputed by the next `update_aggregates`.
+AGGREGATES_VERSION = 2
+AGGREGATE_TABLES = ("exercise_record", "exercise_e1rm", "weekly_volume", "weekly_workouts")
+
+NEW_SETS_QUERY = """
+select _id, time, exercise, workout, weight, reps
+from entry
+where (time, _id) > (?, ?)
+order by time, _id
+"""
+
+def estimate_1rm(weight: float, reps: int) -> float:
+    '''Epley estimate of the one-rep max.'''
+    return weight if reps <= 1 else weight * (1 + reps / 30)
+
+def day_of(time: int) -> str:
+    return datetime.fromtimestamp(time).date().isoformat()
+
+def week_of(time: int) -> str:
+    date = datetime.fromtimestamp(time).date()
+    return (date - timedelta(days=date.weekday())).isoformat()
+
+def connect(path: str = HISTORY_PATH) -> sqlite3.Connection:
+    conn = history.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+def connect_readonly(path: str = HISTORY_PATH) -> sqlite3.Connection:
+    '''Connection for the analytics queries, see `history.connect_readonly`.
+
+    A history.db from before the aggregates existed gets them folded in once.
+    '''
+    conn = history.connect_readonly(path)
+    if conn.execute("select 1 from sqlite_master where name = 'weekly_workouts'").fetchone() is None:
+        conn.close()
+        update_aggregates(path)
+        conn = history.connect_readonly(path)
+    return conn
+
+def aggregates_mark(conn: sqlite3.Connection) -> Tuple[int, int]:
+    return get_meta(conn, "aggregates_time", -1), get_meta(conn, "aggregates_id", -1)
+
+def update_aggregates(path: str = HISTORY_PATH) -> int:
+    '''Fold entries merged since the last call into the aggregate tables.
+
+    The first call on an existing history.db backfills from the whole
+    `entry` table. Returns the number of sets folded in.
+    '''
+    conn = connect(path)
+    try:
+        with conn:
+            if get_meta(conn, "aggregates_version", 1) != AGGREGATES_VERSION:
+                clear_aggregates(conn)
+            return fold_new_sets(conn)
+    finally:
+        conn.close()
+
+def rebuild_aggregates(path: str = HISTORY_PATH) -> int:
+    '''Recompute the aggregates from the whole `entry` table, for when sets
+    older than the high-water mark were added, e.g. by `backfill.py`.'''
+    conn = connect(path)
+    try:
+        with conn:
+            clear_aggregates(conn)
+            return fold_new_sets(conn)
+    finally:
+        conn.close()
+
+def clear_aggregates(conn: sqlite3.Connection):
+    for table in AGGREGATE_TABLES:
+        conn.execute(f"delete from {table}")
+    conn.execute("delete from meta where key in ('aggregates_time', 'aggregates_id')")
+    set_meta(conn, "aggregates_version", AGGREGATES_VERSION)
+
+def fold_new_sets(conn: sqlite3.Connection) -> int:
+    mark_time, mark_id = aggregates_mark(conn)
+    rows = conn.execute(NEW_SETS_QUERY, (mark_time, mark_id)).fetchall()
+    if not rows:
+        return 0
+
+    records: Dict[int, list] = {}
+    e1rms: Dict[Tuple[int, str], float] = {}
+    volume: Dict[Tuple[str, int], list] = {}
+    weeks: Dict[str, list] = {}
+    workouts: Dict[int, int] = {}
+    for _, time, exercise, workout, weight, reps in rows:
+        record = records.get(exercise)
+        if record is None:
+            row = conn.execute("select max_weight, max_weight_reps, max_weight_time, best_e1rm, best_e1rm_time, "
+                               "max_reps, max_reps_time, sets from exercise_record where exercise = ?", (exercise,)).fetchone()
+            record = records[exercise] = list(row) if row else [None, None, None, None, None, 0, None, 0]
+        record[7] += 1
+        if reps > record[5]:
+            record[5:7] = reps, time
+        # A set of no reps lifted nothing, so it sets no weight record.
+        if weight > 0 and reps > 0:
+            if record[0] is None or weight > record[0] or (weight == record[0] and reps > record[1]):
+                record[0:3] = weight, reps, time
+            e1rm = estimate_1rm(weight, reps)
+            if record[3] is None or e1rm > record[3]:
+                record[3:5] = e1rm, time
+            key = exercise, day_of(time)
+            e1rms[key] = max(e1rms.get(key, 0), e1rm)
+
+        week = week_of(time)
+        totals = volume.setdefault((week, exercise), [0, 0, 0.0])
+        totals[0] += 1
+        totals[1] += reps
+        totals[2] += weight * reps
+        weeks.setdefault(week, [0, 0])[1] += 1
+        if workout is not None and workout not in workouts:
+            workouts[workout] = time
+
+    # A workout counts once, in the week of its first set.
+    for workout, time in workouts.items():
+        seen = conn.execute("select 1 from entry where workout = ? and (time, _id) <= (?, ?) limit 1",
+                            (workout, mark_time, mark_id)).fetchone()
+        if seen is None:
+            weeks.setdefault(week_of(time), [0, 0])[0] += 1
+
+    conn.executemany("insert or replace into exercise_record (exercise, max_weight, max_weight_reps, max_weight_time, "
+                     "best_e1rm, best_e1rm_time, max_reps, max_reps_time, sets) values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     [(exercise, *record) for exercise, record in records.items()])
+    conn.executemany("insert into exercise_e1rm (exercise, day, e1rm) values (?, ?, ?) "
+                     "on conflict (exercise, day) do update set e1rm = max(e1rm, excluded.e1rm)",
+                     [(exercise, day, e1rm) for (exercise, day), e1rm in e1rms.items()])
+    conn.executemany("insert into weekly_volume (week, exercise, sets, reps, volume) values (?, ?, ?, ?, ?) "
+                     "on conflict (week, exercise) do update set sets = sets + excluded.sets, "
+                     "reps = reps + excluded.reps, volume = volume + excluded.volume",
+                     [(week, exercise, *totals) for (week, exercise), totals in volume.items()])
+    conn.executemany("insert into weekly_workouts (week, workouts, sets) values (?, ?, ?) "
+                     "on conflict (week) do update set workouts = workouts + excluded.workouts, sets = sets + excluded.sets",
+                     [(week, *totals) for week, totals in weeks.items()])
+
+    set_meta(conn, "aggregates_time", rows[-1][1])
+    set_meta(conn, "aggregates_id", rows[-1][0])
+    return len(rows)
+
+def convert(weight: Optional[float], exercise_unit: Optional[str], unit: str) -> Optional[float]:
+    '''Convert a stored (kg) weight for display, following `format_set`:
+    "native" keeps each exercise's own unit, "lbs"/"kg" convert everything.
+    Bodyweight exercises have no weight.'''
+    if weight is None or exercise_unit is None:
+        return None
+    if unit == "lbs" or (unit == "native" and exercise_unit == "lbs"):
+        return round(kg_to_lbs(weight), 1)
+    return round(weight, 1)
+
+def display_unit(exercise_unit: Optional[str], unit: str) -> Optional[str]:
+    if exercise_unit is None:
+        return None
+    return exercise_unit if unit == "native" else unit
+
+def timestamp(time: Optional[int]) -> Optional[str]:
+    return None if time is None else datetime.fromtimestamp(time).isoformat()
+
+def personal_records(conn: sqlite3.Connection, unit: str = "native") -> List[Dict]:
+    result = []
+    for (exercise, name, exercise_unit, max_weight, max_weight_reps, max_weight_time, best_e1rm, best_e1rm_time,
+         max_reps, max_reps_time, sets) in conn.execute(
+            "select r.exercise, e.name, e.unit, max_weight, max_weight_reps, max_weight_time, best_e1rm, best_e1rm_time, "
+            "max_reps, max_reps_time, sets from exercise_record r join exercise e on e._id = r.exercise order by e.name"):
+        exercise_unit = parse_unit(exercise_unit)
+        result.append({
+            "exercise": exercise,
+            "name": name,
+            "unit": display_unit(exercise_unit, unit),
+            "max_weight": convert(max_weight, exercise_unit, unit),
+            "max_weight_reps": max_weight_reps,
+            "max_weight_time": timestamp(max_weight_time),
+            "e1rm": convert(best_e1rm, exercise_unit, unit),
+            "e1rm_time": timestamp(best_e1rm_time),
+            "max_reps": max_reps,
+            "max_reps_time": timestamp(max_reps_time),
+            "sets": sets,
+        })
+    return result
+
+def exercise_unit_of(conn: sqlite3.Connection, exercise: int) -> Tuple[Optional[str], Optional[str]]:
+    '''(name, unit) of an exercise, (None, None) if unknown.'''
+    row = conn.execute("select name, unit from exercise where _id = ?", (exercise,)).fetchone()
+    return (None, None) if row is None else (row[0], parse_unit(row[1]))
+
+def e1rm_trend(conn: sqlite3.Connection, exercise: int, unit: str = "native", since: Optional[str] = None) -> Optional[Dict]:
+    '''Best estimated 1RM per training day of one exercise, or None if unknown.'''
+    name, exercise_unit = exercise_unit_of(conn, exercise)
+    if name is None:
+        return None
+    rows = conn.execute("select day, e1rm from exercise_e1rm where exercise = ? and day >= ? order by day",
+                        (exercise, since or ""))
+    return {
+        "exercise": exercise,
+        "name": name,
+        "unit": display_unit(exercise_unit, unit),
+        "points": [{"day": day, "e1rm": convert(e1rm, exercise_unit, unit)} for day, e1rm in rows],
+    }
+
+def weekly_volume(conn: sqlite3.Connection, unit: str = "native", since: Optional[str] = None,
+                  exercise: Optional[int] = None) -> Dict:
+    '''Sets, reps and volume (weight × reps) per week.
+
+    Totals over all exercises mix units, so "native" is reported in kg
+    unless a single exercise is selected.
+    '''
+    if exercise is None:
+        exercise_unit = "kg"
+        rows = conn.execute("select week, sum(sets), sum(reps), sum(volume) from weekly_volume "
+                            "where week >= ? group by week order by week", (since or "",))
+    else:
+        _, exercise_unit = exercise_unit_of(conn, exercise)
+        rows = conn.execute("select week, sets, reps, volume from weekly_volume "
+                            "where exercise = ? and week >= ? order by week", (exercise, since or ""))
+    volume_unit = display_unit(exercise_unit, unit)
+    return {
+        "exercise": exercise,
+        "unit": volume_unit,
+        "weeks": [{"week": week, "sets": sets, "reps": reps,
+                   "volume": convert(volume, exercise_unit, unit) if volume_unit else 0}
+                  for week, sets, reps, volume in rows],
+    }
+
+def workout_frequency(conn: sqlite3.Connection, since: Optional[str] = None) -> List[Dict]:
+    return [{"week": week, "workouts": workouts, "sets": sets}
+            for week, workouts, sets in conn.execute("select week, workouts, sets from weekly_workouts "
+                                                     "where week >= ? order by week", (since or "",))]
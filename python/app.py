@@ -1,17 +1,30 @@
-import asyncio
 import os
+from datetime import date, datetime
 import pprint
-import threading
+import sys
 import logging
-from flask import Flask, request, url_for, make_response, send_file
-from dotenv import load_dotenv
-import urllib3
-import shelve
-from onedrive import get_zip, register_subscription
+import time
+from contextlib import closing
+from flask import Flask, abort, g, jsonify, request, url_for, make_response, send_file
+from urllib.parse import urlsplit
 
-from gymrun import process_zip
-from post import toot_card
-from render import build_svg, load_data, render
+# Before the modules below, which read their settings when imported.
+import config
+config.load()
+
+from onedrive import TOKEN_CACHE_PATH, ZIP_PATH, download_stats, get_credential, get_zip_if_changed, register_subscription
+
+import analytics
+import export
+from eventloop import run, run_cpu
+from history import HISTORY_PATH
+from jobs import JobQueue
+from pipeline import ingest, publish_data
+import metrics
+from tenants import DEFAULT_TENANT, channel_token, client_state, get_tenant, register_subscription_tenant, tenant_for_channel, tenant_for_notification
+from post import POST_TARGETS, caption, toot_card
+from render import DATA_PATH, card_etag, card_key, get_card_svg, get_workout_card, load_data, load_data_cached, normalize_unit, workout_card_key
+from artifacts import ENCODINGS, artifact_path, get_card, negotiate_encoding, refresh_artifacts
 
 logger = logging.getLogger('gunicorn.error')
 
@@ -48,18 +61,28 @@ class ReverseProxied(object):
             environ['wsgi.url_scheme'] = scheme
         return self.app(environ, start_response)
 
-load_dotenv()
+# Without a key, /account never triggers a refresh.
+FORCE_REFRESH_KEY = os.environ.get('FORCE_REFRESH_KEY')
 
-FORCE_REFRESH_KEY = os.environ['FORCE_REFRESH_KEY']
-SHELVE_PATH = "shelve.db"
+jobs = JobQueue()
 
 app = Flask(__name__)
 app.wsgi_app = ReverseProxied(app.wsgi_app)
-app.secret_key = os.environ['FLASK_SECRET_KEY']
+app.secret_key = os.environ.get('FLASK_SECRET_KEY')
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    metrics.observe("gymrun_request_seconds", time.perf_counter() - g.get("request_start", time.perf_counter()),
+                    endpoint=request.endpoint or "unknown", status=response.status_code)
+    return response
 
 def get_url(route):
     '''Generate a proper URL, forcing HTTPS if not running locally'''
-    host = urllib3.util.parse_url(request.url).hostname
+    host = urlsplit(request.url).hostname
     url = url_for(
         route,
         _external=True,
@@ -68,78 +91,271 @@ def get_url(route):
 
     return url
 
-def store(key, channel):
-    with shelve.open(SHELVE_PATH) as db:
-        db[key] = channel
-        db.sync()
+def tenant_or_404(name):
+    tenant = get_tenant(name)
+    if tenant is None:
+        abort(404)
+    return tenant
 
-def get(key):
-    with shelve.open(SHELVE_PATH) as db:
-        if key not in db:
-            return None
-        return db[key]
+async def fetch_backup(tenant, last_version):
+    if tenant.source == "drive":
+        # Imported on first use so OneDrive-only deployments need no Google account.
+        import drive
+        return await drive.get_zip_if_changed(last_version, tenant.state(), drive.get_credential(tenant.path(drive.CREDENTIALS_PATH)))
+    return await get_zip_if_changed(last_version, get_credential(tenant.path(TOKEN_CACHE_PATH)), tenant.zip_path or ZIP_PATH)
 
-async def process_file(force=False):
-    zip = await get_zip()
-    data = process_zip(zip)
+def process_file(tenant, force=False):
+    '''Runs on a job worker thread: the state store is only used from here,
+    the download goes to the event loop and ingesting and publishing to the
+    CPU workers, so neither ever waits on SQLite.'''
+    tenant_state = tenant.state()
+    zip, version = run(fetch_backup(tenant, None if force else tenant_state.get("zip_version")))
+    if zip is None:
+        return ""
+    previous = {} if force else tenant_state.get("fingerprint") or {}
+    data, fingerprint = run(run_cpu(ingest, tenant, zip, previous))
+    fingerprint = {**previous, **fingerprint}
+
+    def handled():
+        # Saved only once the backup is fully handled, so a failed run is retried in full.
+        tenant_state.set("zip_version", version)
+        tenant_state.set("fingerprint", fingerprint)
+
+    if data is None:
+        handled()
+        return ""
 
     new_time = max(map(lambda x: x.time, sum(data, [])))
-    last_time = get("last_time")
-    if not force and last_time and new_time <= last_time:
+    last_time = tenant_state.get("last_time")
+    if not force and last_time is not None and new_time <= last_time:
+        handled()
         return ""
-    store("last_time", new_time)
 
-    render(data)
-    return toot_card(data, new_time)
+    manifest = run(run_cpu(publish_data, tenant, data))
+    # Also only advanced after publishing, or a retry would see nothing new.
+    if force:
+        tenant_state.set("last_time", new_time)
+    elif not tenant_state.set_if_greater("last_time", new_time):
+        handled()
+        return ""
+    # Posting is its own job so a failed post is retried without reprocessing.
+    # It posts exactly this card and caption, whatever has been published by the time it runs.
+    jobs.enqueue(f"post:{tenant.name}", {"tenant": tenant.name, "time": new_time.timestamp(),
+                                         "png": manifest["cards"]["native"]["png"], "text": caption(data)}, debounce=0)
+    handled()
+    return new_time
 
-def run_async_process_file():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(process_file())
-    loop.close()
+@jobs.handler("process")
+def process_job(payload):
+    # Jobs queued before tenants existed carry no tenant.
+    tenant = get_tenant(payload.get("tenant", DEFAULT_TENANT))
+    return process_file(tenant, force=payload.get("force", False))
 
-@app.route('/')
-def index():
+@jobs.handler("post")
+def post_job(payload):
+    tenant = get_tenant(payload.get("tenant", DEFAULT_TENANT))
+    if "png" in payload:
+        png_path, text = artifact_path(tenant.root, payload["png"]), payload["text"]
+    else:
+        # Queued by earlier versions, which posted the current card.
+        png_path, text = tenant.path("card.png"), caption(load_data(tenant.path(DATA_PATH)))
+    return toot_card(png_path, text, datetime.fromtimestamp(payload["time"]),
+                     POST_TARGETS if tenant.post_targets is None else tenant.post_targets, tenant.state())
+
+def refresh_cards(tenant):
+    # Queued per tenant like its other jobs, so serving never renders.
+    jobs.enqueue(f"refresh:{tenant.name}", {"tenant": tenant.name}, debounce=0)
+
+@jobs.handler("refresh")
+def refresh_job(payload):
+    tenant = get_tenant(payload.get("tenant", DEFAULT_TENANT))
+    run(run_cpu(refresh_artifacts, tenant.root))
+
+jobs.start()
+
+@app.route('/', defaults={"tenant": DEFAULT_TENANT})
+@app.route('/<tenant>/')
+def index(tenant):
+    tenant_or_404(tenant)
     html = (
         '<p><a href="./card.svg" target="_blank"><img src="./card.svg" style="width: 100%;" alt="Social Card Preview" /></a></p>'
         '<p><a href="https://github.com/blueset/gymrun" target="_blank">https://github.com/blueset/gymrun</a></p>'
     )
     return html
 
-@app.route('/account', methods=['GET', 'POST'])
-async def account():
-    outcome = load_data()
+@app.route('/account', methods=['GET', 'POST'], defaults={"tenant": DEFAULT_TENANT})
+@app.route('/<tenant>/account', methods=['GET', 'POST'])
+def account(tenant):
+    tenant = tenant_or_404(tenant)
+    try:
+        # The snapshot the cards are served from, mapped once per version.
+        outcome = list(load_data_cached(tenant.path(DATA_PATH))[1])
+    except FileNotFoundError:
+        outcome = "No workout data yet."
     # refresh on post
     if request.method == 'POST':
         refresh_key = request.form.get('refresh_key')
-        if refresh_key == FORCE_REFRESH_KEY:
-            outcome = await process_file(force=True)
+        if FORCE_REFRESH_KEY and refresh_key == FORCE_REFRESH_KEY:
+            outcome = {"job": jobs.enqueue(f"process:{tenant.name}", {"tenant": tenant.name, "force": True}, debounce=0)}
 
     return (f'<form method="post"><input type="password" name="refresh_key" /><input type="submit" value="Refresh"></form>'
             f'<pre>{pprint.pformat(outcome, indent=2)}</pre>')
 
-@app.route("/card.svg")
-def card_svg():
-    unit = request.args.get("unit", "native")
-    data = load_data()
-    svg = build_svg(data, unit)
-    response = make_response(svg)
-    response.headers['Content-Type'] = 'image/svg+xml'
-    response.add_etag()
+def send_artifact(tenant, name, max_age, immutable=False):
+    encoding = negotiate_encoding(name, request.accept_encodings)
+    path = os.path.abspath(artifact_path(tenant.root, name))
+    if encoding:
+        path += ENCODINGS[encoding][0]
+    if not os.path.exists(path):
+        abort(404)
+    # Artifact names are content hashes, so they double as ETags.
+    response = send_file(path, mimetype="image/svg+xml" if name.endswith(".svg") else "image/png",
+                         etag=f"{name}-{encoding or 'identity'}", conditional=True)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    metrics.inc("gymrun_card_cache_total", endpoint=request.endpoint,
+                result="not_modified" if response.status_code == 304 else "artifact")
+    response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = (f"public, max-age={max_age}, immutable" if immutable
+                                         else f"public, max-age={max_age}, stale-if-error=60")
+    return response
+
+def send_workout_card(tenant, kind, unit):
+    workout = request.args.get("workout", type=int)
+    date = request.args.get("date")
+    if date is not None:
+        try:
+            date = datetime.strptime(date, "%Y-%m-%d").date().isoformat()
+        except ValueError:
+            abort(400)
+    key = workout_card_key(workout, date, unit, kind, tenant.path(HISTORY_PATH))
+    if key is None:
+        abort(404)
+    etag = card_etag(key)
+    if etag in request.if_none_match:
+        metrics.inc("gymrun_card_cache_total", endpoint=f"workout_{kind}", result="not_modified")
+        response = make_response("", 304)
+    else:
+        response = make_response(get_workout_card(key))
+        response.headers['Content-Type'] = "image/svg+xml" if kind == "svg" else "image/png"
+    response.set_etag(etag)
     response.headers["Cache-Control"] = "public, max-age=3600, stale-if-error=60"
     return response
 
-@app.route("/card.png")
-def card_png():
-    return send_file("card.png")
+@app.route("/card.svg", defaults={"tenant": DEFAULT_TENANT})
+@app.route("/<tenant>/card.svg")
+def card_svg(tenant):
+    tenant = tenant_or_404(tenant)
+    unit = normalize_unit(request.args.get("unit", "native"))
+    if "workout" in request.args or "date" in request.args:
+        return send_workout_card(tenant, "svg", unit)
+    card = get_card(unit, tenant.root, refresh=lambda: refresh_cards(tenant))
+    if card is not None:
+        return send_artifact(tenant, card["svg"], 3600)
+
+    # No artifacts built yet, render from the data snapshot.
+    key = card_key(unit, tenant.path(DATA_PATH))
+    etag = card_etag(key)
+    if etag in request.if_none_match:
+        metrics.inc("gymrun_card_cache_total", endpoint="card.svg", result="not_modified")
+        response = make_response("", 304)
+    else:
+        response = make_response(get_card_svg(key))
+        response.headers['Content-Type'] = 'image/svg+xml'
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "public, max-age=3600, stale-if-error=60"
+    return response
+
+@app.route("/card.png", defaults={"tenant": DEFAULT_TENANT})
+@app.route("/<tenant>/card.png")
+def card_png(tenant):
+    tenant = tenant_or_404(tenant)
+    unit = normalize_unit(request.args.get("unit", "native"))
+    if "workout" in request.args or "date" in request.args:
+        return send_workout_card(tenant, "png", unit)
+    card = get_card(unit, tenant.root, refresh=lambda: refresh_cards(tenant))
+    if card is not None:
+        return send_artifact(tenant, card["png"], 3600)
+    return send_file(os.path.abspath(tenant.path("card.png")))
+
+@app.route("/cards/<name>", defaults={"tenant": DEFAULT_TENANT})
+@app.route("/<tenant>/cards/<name>")
+def card_artifact(tenant, name):
+    tenant = tenant_or_404(tenant)
+    if name != os.path.basename(name) or not name.startswith("card-"):
+        abort(404)
+    return send_artifact(tenant, name, 365 * 24 * 3600, immutable=True)
+
+def analytics_connection(tenant):
+    try:
+        return closing(analytics.connect_readonly(tenant_or_404(tenant).path(HISTORY_PATH)))
+    except FileNotFoundError:
+        # No backup processed yet.
+        abort(404)
+
+@app.route("/analytics/records", defaults={"tenant": DEFAULT_TENANT})
+@app.route("/<tenant>/analytics/records")
+def analytics_records(tenant):
+    with analytics_connection(tenant) as conn:
+        return jsonify(analytics.personal_records(conn, normalize_unit(request.args.get("unit", "native"))))
+
+@app.route("/analytics/e1rm/<int:exercise>", defaults={"tenant": DEFAULT_TENANT})
+@app.route("/<tenant>/analytics/e1rm/<int:exercise>")
+def analytics_e1rm(tenant, exercise):
+    with analytics_connection(tenant) as conn:
+        trend = analytics.e1rm_trend(conn, exercise, normalize_unit(request.args.get("unit", "native")),
+                                     request.args.get("since"))
+    if trend is None:
+        abort(404)
+    return jsonify(trend)
+
+@app.route("/analytics/volume", defaults={"tenant": DEFAULT_TENANT})
+@app.route("/<tenant>/analytics/volume")
+def analytics_volume(tenant):
+    with analytics_connection(tenant) as conn:
+        return jsonify(analytics.weekly_volume(conn, normalize_unit(request.args.get("unit", "native")),
+                                               request.args.get("since"), request.args.get("exercise", type=int)))
+
+@app.route("/analytics/frequency", defaults={"tenant": DEFAULT_TENANT})
+@app.route("/<tenant>/analytics/frequency")
+def analytics_frequency(tenant):
+    with analytics_connection(tenant) as conn:
+        return jsonify(analytics.workout_frequency(conn, request.args.get("since")))
+
+@app.route("/export.<format>", defaults={"tenant": DEFAULT_TENANT})
+@app.route("/<tenant>/export.<format>")
+def export_history(tenant, format):
+    tenant = tenant_or_404(tenant)
+    if format not in export.FORMATS:
+        abort(404)
+    if not export.supported(format):
+        abort(501)
+    try:
+        since, until = (date.fromisoformat(request.args[name]) if name in request.args else None for name in ("since", "until"))
+        exercise = int(request.args["exercise"]) if "exercise" in request.args else None
+    except ValueError:
+        abort(400)
+    # Streamed straight from the cursor, one chunk at a time.
+    try:
+        chunks = export.export(format, tenant.path(HISTORY_PATH), since, until, exercise)
+    except FileNotFoundError:
+        abort(404)
+    return app.response_class(chunks, mimetype=export.FORMATS[format][1],
+                              headers={"Content-Disposition": f'attachment; filename="gymrun-{tenant.name}.{format}"'})
 
 @app.route("/webhook", methods=['POST'])
 def webhook():
     logging.info(f"webhook {repr(request.headers)}")
     
     try:
-        if "value" in request.json:
-            threading.Thread(target=run_async_process_file).start()
+        # One job per tenant however many notifications arrive; the queue
+        # debounces them and shares workers fairly between tenants.
+        for notification in request.json.get("value", []):
+            tenant = tenant_for_notification(notification)
+            if tenant is None:
+                logging.warning(f"webhook dropped notification for subscription {notification.get('subscriptionId')}")
+                continue
+            jobs.enqueue(f"process:{tenant.name}", {"tenant": tenant.name})
     except Exception as e:
         logging.error(f"webhook {e}")
 
@@ -153,9 +369,59 @@ def webhook():
 
     return ""
 
-@app.route("/resubscribe")
-async def resub():
-    await register_subscription(get_url("webhook"))
+@app.route("/webhook/drive", methods=['POST'])
+def drive_webhook():
+    # Channels are created with `channel_token` as their token; "sync" only
+    # confirms a new channel.
+    if request.headers.get("X-Goog-Resource-State") != "sync":
+        tenant = tenant_for_channel(request.headers.get("X-Goog-Channel-Token"))
+        if tenant is None or tenant.source != "drive":
+            logging.warning(f"drive webhook dropped notification for channel {request.headers.get('X-Goog-Channel-Id')}")
+            return ""
+        jobs.enqueue(f"process:{tenant.name}", {"tenant": tenant.name})
+    return ""
+
+@app.route("/queue")
+def queue_stats():
+    return jobs.stats()
+
+def pipeline_gauges():
+    stats = jobs.stats()
+    for status, count in stats["depth"].items():
+        yield "gymrun_job_queue_depth", {"status": status}, count
+    for name in ("p50", "max"):
+        if stats["latency"][name] is not None:
+            yield "gymrun_job_latency_seconds", {"quantile": name}, stats["latency"][name]
+    for tenant, counts in stats["tenants"].items():
+        for status, count in counts.items():
+            yield "gymrun_job_tenant_depth", {"tenant": tenant, "status": status}, count
+    for name, value in download_stats.items():
+        yield f"gymrun_onedrive_{name}", {}, value
+    # Only loaded once a tenant reads its backups from Google Drive.
+    if "drive" in sys.modules:
+        for name, value in sys.modules["drive"].download_stats.items():
+            yield f"gymrun_drive_{name}", {}, value
+
+metrics.register_collector(pipeline_gauges)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+@app.route("/resubscribe", defaults={"tenant": DEFAULT_TENANT})
+@app.route("/<tenant>/resubscribe")
+def resub(tenant):
+    tenant = tenant_or_404(tenant)
+    if tenant.source == "drive":
+        import drive
+        run(drive.resubscribe(get_url("drive_webhook"), channel_token(tenant), tenant.state(),
+                              drive.get_credential(tenant.path(drive.CREDENTIALS_PATH))))
+        return "OK"
+    secret = client_state(tenant)
+    subscription = run(register_subscription(get_url("webhook"), get_credential(tenant.path(TOKEN_CACHE_PATH)),
+                                             tenant.zip_path or ZIP_PATH, client_state=secret))
+    if subscription is not None and subscription.id:
+        register_subscription_tenant(subscription.id, tenant, secret)
     return "OK"
 
 if __name__=='__main__':
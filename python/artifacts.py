@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+import brotli
+import humanize
+
+from gymrun import Exercise
+from raster import Rasterizer, get_rasterizer
+from render import DATA_PATH, build_svg, get_last_time, load_data
+
+ARTIFACT_DIR = "cards"
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = ".lock"
+UNITS = ("native", "kg", "lbs")
+# Unreferenced artifacts are kept this long so in-flight responses can finish.
+ARTIFACT_GRACE = 3600
+
+# Precompressed siblings of each SVG, by Content-Encoding.
+ENCODINGS = {
+    "br": (".br", lambda b: brotli.compress(b, quality=11)),
+    "gzip": (".gz", lambda b: gzip.compress(b, 9, mtime=0)),
+}
+
+def write_atomic(path: str, data: bytes):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def artifact_path(root: str, *names: str) -> str:
+    '''Path under the artifact directory of a tenant `root` ("." for the default tenant).'''
+    return os.path.normpath(os.path.join(root, ARTIFACT_DIR, *names))
+
+def store_artifact(data: bytes, stem: str, ext: str, root: str = ".") -> str:
+    name = f"{stem}-{hashlib.sha1(data).hexdigest()[:16]}{ext}"
+    path = artifact_path(root, name)
+    if not os.path.exists(path):
+        write_atomic(path, data)
+    return name
+
+@contextmanager
+def artifacts_lock(root: str = "."):
+    '''Held, across processes, while the artifacts of `root` are built.'''
+    os.makedirs(artifact_path(root), exist_ok=True)
+    with open(artifact_path(root, LOCK_NAME), "a") as f:
+        # Released when the file is closed.
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def build_artifacts(data: List[List[Exercise]], rasterizer: Optional[Rasterizer] = None, root: str = ".") -> Dict:
+    '''Render SVG and PNG cards for every unit into content-hashed files.
+
+    SVGs are also stored brotli/gzip-compressed next to the original, and
+    the native PNG and SVG are copied to card.png/card.svg. Returns the
+    manifest, which is swapped in atomically last. Call with
+    `artifacts_lock(root)` held.
+    '''
+    rasterizer = rasterizer or get_rasterizer()
+    os.makedirs(artifact_path(root), exist_ok=True)
+    last_time = get_last_time(data)
+    manifest = {
+        "time": last_time.timestamp(),
+        "last_update": humanize.naturaltime(datetime.now() - last_time),
+        "cards": {},
+    }
+    for unit in UNITS:
+        svg = build_svg(data, unit).encode()
+        raster_svg = svg.decode() if rasterizer.embed_font else build_svg(data, unit, font_url=True)
+        png = rasterizer.rasterize(raster_svg)
+
+        svg_name = store_artifact(svg, f"card-{unit}", ".svg", root)
+        for suffix, compress in ENCODINGS.values():
+            path = artifact_path(root, svg_name + suffix)
+            if not os.path.exists(path):
+                write_atomic(path, compress(svg))
+        manifest["cards"][unit] = {
+            "svg": svg_name,
+            "png": store_artifact(png, f"card-{unit}", ".png", root),
+        }
+        if unit == "native":
+            write_atomic(os.path.join(root, "card.svg"), svg)
+            write_atomic(os.path.join(root, "card.png"), png)
+
+    write_atomic(artifact_path(root, MANIFEST_NAME), json.dumps(manifest).encode())
+    prune_artifacts(manifest, root)
+    return manifest
+
+def prune_artifacts(manifest: Dict, root: str = "."):
+    keep = {MANIFEST_NAME, LOCK_NAME}
+    for card in manifest["cards"].values():
+        keep.add(card["png"])
+        keep.add(card["svg"])
+        keep.update(card["svg"] + suffix for suffix, _ in ENCODINGS.values())
+    cutoff = time.time() - ARTIFACT_GRACE
+    for entry in os.scandir(artifact_path(root)):
+        if entry.name not in keep and entry.stat().st_mtime < cutoff:
+            os.unlink(entry.path)
+
+# root -> (manifest mtime, manifest), reloaded only when the file changes.
+_manifests: Dict[str, tuple] = {}
+# root -> mtime of the manifest a refresh was last requested for.
+_refresh_requested: Dict[str, int] = {}
+
+def load_manifest(root: str = ".") -> Optional[Dict]:
+    path = artifact_path(root, MANIFEST_NAME)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    loaded = _manifests.get(root)
+    if loaded is None or loaded[0] != mtime:
+        with open(path) as f:
+            loaded = _manifests[root] = (mtime, json.load(f))
+    return loaded[1]
+
+def is_stale(manifest: Dict) -> bool:
+    '''Whether the humanized "last updated" text baked into the cards is out of date.'''
+    return humanize.naturaltime(datetime.now() - datetime.fromtimestamp(manifest["time"])) != manifest["last_update"]
+
+def refresh_artifacts(root: str = "."):
+    '''Re-render the cards of `root` from its data snapshot if they are stale.
+
+    Runs as a job. The snapshot is read under the lock, so a refresh
+    racing with a new workout being published never replaces its cards
+    with older ones.
+    '''
+    with artifacts_lock(root):
+        manifest = load_manifest(root)
+        if manifest is not None and is_stale(manifest):
+            build_artifacts(load_data(os.path.join(root, DATA_PATH)), root=root)
+
+def get_card(unit: str, root: str = ".", refresh: Optional[Callable[[], object]] = None) -> Optional[Dict]:
+    '''Manifest entry for `unit`, or None if no artifacts have been built.
+
+    When the cards are stale, `refresh` is called, once per process and
+    manifest, to have them re-rendered elsewhere; the current artifacts
+    are still returned.
+    '''
+    manifest = load_manifest(root)
+    if manifest is None:
+        return None
+    if refresh is not None and is_stale(manifest):
+        mtime = _manifests[root][0]
+        if _refresh_requested.get(root) != mtime:
+            _refresh_requested[root] = mtime
+            refresh()
+    return manifest["cards"].get(unit)
+
+def negotiate_encoding(name: str, accept_encodings) -> Optional[str]:
+    '''Best precompressed encoding of an SVG artifact accepted by the client.'''
+    if not name.endswith(".svg"):
+        return None
+    for encoding in ENCODINGS:
+        if accept_encodings[encoding]:
+            return encoding
+    return None
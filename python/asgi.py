@@ -0,0 +1,34 @@
+'''ASGI entry point, sharing the server's event loop with the app.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5001 --workers 4
+
+Flask views stay synchronous and run on their own thread per request,
+while `eventloop.run` and `run_cpu` schedule their work on uvicorn's loop.
+The WSGI app (`app:app`) still works under gunicorn.
+'''
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app
+import eventloop
+
+wsgi_application = WsgiToAsgi(app)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            eventloop.use_running_loop()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await eventloop.get_event_loop().aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    # Without a context of its own, every request would share asgiref's
+    # single sync thread and be served one at a time.
+    async with ThreadSensitiveContext():
+        await wsgi_application(scope, receive, send)
@@ -0,0 +1,216 @@
+'''Rebuild history, and optionally workout cards, from archived backups.
+
+    python backfill.py archive/ --jobs 8
+    python backfill.py archive/ --tenant alice --cards cards/history --card-format png
+
+Backups (gymapp.zip, or bare gymapp.db files from Google Drive) are
+decrypted, queried and parsed in a process pool, and merged into the
+tenant's history.db oldest first, so the newest copy of an entry wins.
+Each merged backup is recorded in history.db in the same transaction;
+rerunning skips those, so an interrupted backfill resumes where it stopped.
+'''
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Callable, List, NamedTuple, Optional
+
+import analytics
+from gymrun import get_sqlite_file, parse_properties
+import history
+from history import HISTORY_PATH, NEW_ENTRIES_QUERY, high_water_mark, set_meta
+
+BACKUP_SUFFIXES = (".zip", ".db")
+
+SCHEMA = """
+create table if not exists backfill (
+    path text primary key,
+    size integer not null,
+    mtime_ns integer not null,
+    entries integer not null,
+    -- Entries that were new or differed from the stored copy.
+    added integer not null,
+    merged real not null
+);
+"""
+
+# Rows only count as changes when they are new or differ from the stored copy.
+MERGE_ENTRY = """
+insert into entry (_id, time, exercise, workout, set_number, weight, reps) values (?, ?, ?, ?, ?, ?, ?)
+on conflict (_id) do update set time = excluded.time, exercise = excluded.exercise, workout = excluded.workout,
+    set_number = excluded.set_number, weight = excluded.weight, reps = excluded.reps
+where (entry.time, entry.exercise, entry.workout, entry.set_number, entry.weight, entry.reps)
+    is not (excluded.time, excluded.exercise, excluded.workout, excluded.set_number, excluded.weight, excluded.reps)
+"""
+
+class Backup(NamedTuple):
+    path: str
+    size: int
+    mtime_ns: int
+    exercises: List[tuple]
+    workouts: List[tuple]
+    # (_id, time, exercise, workout, set_number, weight, reps) as in history.entry.
+    entries: List[tuple]
+
+def find_backups(directory: str) -> List[str]:
+    paths = [os.path.abspath(os.path.join(root, name))
+             for root, _, names in os.walk(directory) for name in names if name.endswith(BACKUP_SUFFIXES)]
+    # Oldest first, so newer copies of an entry replace older ones.
+    return sorted(paths, key=lambda path: (os.stat(path).st_mtime_ns, path))
+
+def extract(path: str) -> Backup:
+    '''Decrypt one backup and parse all of its entries; runs in a pool worker.'''
+    st = os.stat(path)
+    with open(path, "rb") as f:
+        sqlite_file = get_sqlite_file(f.read())
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("attach ':memory:' as backup")
+        conn.deserialize(sqlite_file, name="backup")
+        conn.execute("create index backup.workout_time_start on workout (time_start)")
+        exercises = conn.execute("select _id, xlabel, unit from backup.exercise").fetchall()
+        workouts = conn.execute("select _id, time_start, time_end from backup.workout").fetchall()
+        entries = [(entry_id, time, exercise, workout, *parse_properties(data))
+                   for entry_id, time, exercise, workout, data in conn.execute(NEW_ENTRIES_QUERY, (-1, -1))]
+    finally:
+        conn.close()
+    return Backup(path, st.st_size, st.st_mtime_ns, exercises, workouts, entries)
+
+def merge(conn: sqlite3.Connection, backup: Backup) -> int:
+    '''Merge one extracted backup and record it. Returns the number of entries
+    that were new to the history or edited since the copy stored.'''
+    with conn:
+        conn.executemany("insert or replace into exercise (_id, name, unit) values (?, ?, ?)", backup.exercises)
+        conn.executemany("insert or replace into workout (_id, time_start, time_end) values (?, ?, ?)", backup.workouts)
+        before = conn.total_changes
+        conn.executemany(MERGE_ENTRY, backup.entries)
+        added = conn.total_changes - before
+        # Entries come ordered by (time, _id); live updates continue after the newest.
+        if backup.entries and (backup.entries[-1][1], backup.entries[-1][0]) > high_water_mark(conn):
+            set_meta(conn, "hwm_time", backup.entries[-1][1])
+            set_meta(conn, "hwm_id", backup.entries[-1][0])
+        conn.execute("insert or replace into backfill (path, size, mtime_ns, entries, added, merged) values (?, ?, ?, ?, ?, ?)",
+                     (backup.path, backup.size, backup.mtime_ns, len(backup.entries), added, time.time()))
+    return added
+
+def pending(conn: sqlite3.Connection, paths: List[str]) -> List[str]:
+    '''Backups not merged yet, or changed on disk since they were.'''
+    done = {path: (size, mtime_ns) for path, size, mtime_ns in conn.execute("select path, size, mtime_ns from backfill")}
+    result = []
+    for path in paths:
+        st = os.stat(path)
+        if done.get(path) != (st.st_size, st.st_mtime_ns):
+            result.append(path)
+    return result
+
+def backfill(paths: List[str], path: str = HISTORY_PATH, jobs: Optional[int] = None,
+             progress: Callable[[str], None] = print) -> dict:
+    conn = history.connect(path)
+    conn.executescript(SCHEMA)
+    todo = pending(conn, paths)
+    stats = {"backups": len(todo), "skipped": len(paths) - len(todo), "failed": 0, "merged": 0, "entries": 0, "added": 0, "bytes": 0}
+    jobs = jobs or os.cpu_count() or 1
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(jobs) as pool:
+            # A bounded window of backups in flight keeps memory flat however
+            # many there are, while results are still merged in order.
+            window = jobs * 2
+            futures = deque()
+            queue = iter(todo)
+            for i in range(1, len(todo) + 1):
+                while len(futures) < window and (next_path := next(queue, None)) is not None:
+                    futures.append((next_path, pool.submit(extract, next_path)))
+                backup_path, future = futures.popleft()
+                try:
+                    backup = future.result()
+                except Exception as e:
+                    stats["failed"] += 1
+                    progress(f"[{i}/{len(todo)}] {backup_path}: failed, {e}")
+                    continue
+                added = merge(conn, backup)
+                stats["merged"] += 1
+                stats["entries"] += len(backup.entries)
+                stats["added"] += added
+                stats["bytes"] += backup.size
+                elapsed = time.perf_counter() - start
+                progress(f"[{i}/{len(todo)}] {os.path.basename(backup_path)}: {len(backup.entries)} entries, {added} new or changed  "
+                         f"({stats['merged'] / elapsed:.1f} backups/s, {stats['entries'] / elapsed:.0f} entries/s)")
+    finally:
+        conn.close()
+    stats["seconds"] = time.perf_counter() - start
+    if stats["added"]:
+        # Backfilled sets can predate what the aggregates already folded in,
+        # or change sets they did.
+        analytics.rebuild_aggregates(path)
+    return stats
+
+def render_card(path: str, workout: int, out: str, card_format: str) -> str:
+    from raster import get_rasterizer
+    from render import build_svg
+    conn = history.connect(path)
+    try:
+        data = history.workout_sets(conn, workout)
+    finally:
+        conn.close()
+    if card_format == "svg":
+        body = build_svg(data).encode()
+    else:
+        rasterizer = get_rasterizer()
+        body = rasterizer.rasterize(build_svg(data, font_url=not rasterizer.embed_font))
+    with open(f"{out}.tmp", "wb") as f:
+        f.write(body)
+    os.replace(f"{out}.tmp", out)
+    return out
+
+def render_cards(path: str, directory: str, card_format: str = "svg", jobs: Optional[int] = None,
+                 progress: Callable[[str], None] = print) -> int:
+    '''Write a card for every workout in the history that has none in `directory` yet.'''
+    os.makedirs(directory, exist_ok=True)
+    conn = history.connect(path)
+    try:
+        workouts = conn.execute("select _id, time_start from workout where exists (select 1 from entry where workout = workout._id) "
+                                "order by time_start").fetchall()
+    finally:
+        conn.close()
+    outs = {workout: os.path.join(directory, f"{datetime.fromtimestamp(time_start):%Y-%m-%d}-{workout}.{card_format}")
+            for workout, time_start in workouts}
+    todo = [workout for workout, out in outs.items() if not os.path.exists(out)]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(render_card, path, workout, outs[workout], card_format) for workout in todo]
+        for i, future in enumerate(futures, 1):
+            future.result()
+            if i % 50 == 0 or i == len(futures):
+                progress(f"cards [{i}/{len(futures)}] ({i / (time.perf_counter() - start):.1f} cards/s)")
+    return len(todo)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild history from archived GymRun backups")
+    parser.add_argument("directory", help="directory searched recursively for *.zip and *.db backups")
+    parser.add_argument("--tenant", help="merge into this tenant's history instead of ./history.db")
+    parser.add_argument("--jobs", type=int, help="worker processes, defaults to the CPU count")
+    parser.add_argument("--cards", metavar="DIR", help="also write a card per workout into DIR")
+    parser.add_argument("--card-format", choices=("svg", "png"), default="svg")
+    args = parser.parse_args()
+
+    path = HISTORY_PATH
+    if args.tenant:
+        from tenants import get_tenant
+        tenant = get_tenant(args.tenant)
+        if tenant is None:
+            sys.exit(f"no such tenant: {args.tenant}")
+        path = tenant.path(HISTORY_PATH)
+
+    stats = backfill(find_backups(args.directory), path, args.jobs)
+    print(f"{stats['backups']} backups ({stats['skipped']} already merged, {stats['failed']} failed), "
+          f"{stats['entries']} entries, {stats['added']} new or changed, in {stats['seconds']:.2f}s: "
+          f"{stats['merged'] / stats['seconds'] if stats['seconds'] else 0:.1f} backups/s, "
+          f"{stats['entries'] / stats['seconds'] if stats['seconds'] else 0:.0f} entries/s, "
+          f"{stats['bytes'] / 1024 / 1024 / stats['seconds'] if stats['seconds'] else 0:.1f} MiB/s")
+    if args.cards:
+        print(f"{render_cards(path, args.cards, args.card_format, args.jobs)} cards written to {args.cards}")
@@ -0,0 +1,419 @@
+'''Benchmarks for the ingest, render and serving paths.
+
+    python bench.py ingest process parse render --size year --save results/before.json
+    python bench.py ingest process parse render --size year --compare results/before.json
+    python bench.py raster --zip gymapp.zip --backend resvg
+    python bench.py startup --save results/startup.json
+    python bench.py snapshot --size year
+    python bench.py export --size decade
+
+Without a backup path, a synthetic one is generated with `synth.py`.
+'''
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+
+import pyzipper
+
+from gymrun import (ZIP_PASSWORD, get_sqlite_file, max_entry_time, parse_data, process_zip, read_sqlite_file,
+                    read_sqlite_header, sqlite_change_counter, zip_entry_fingerprint)
+import synth
+
+# A result more than this much slower than the baseline is flagged.
+REGRESSION_THRESHOLD = 1.10
+
+QUERY = "select entry.time, entry.data, exercise.xlabel, exercise.unit from entry inner join exercise on entry.exercise = exercise._id where entry.time >= (select time_start from workout order by time_start desc limit 1) and entry.time <= (select time_end from workout order by time_start desc limit 1);"
+
+def legacy_ingest(data: bytes):
+    # The temp-file based path `gymrun` used before ingestion went in-memory.
+    with TemporaryDirectory() as ve_dir, NamedTemporaryFile(dir=ve_dir, delete=False) as tmp:
+        tmp.write(data)
+        tmp.flush()
+        tmp.close()
+        with pyzipper.AESZipFile(tmp.name) as zf:
+            zf.setpassword(ZIP_PASSWORD)
+            sqlite_file = zf.read("gymapp.db")
+    with TemporaryDirectory() as ve_dir, NamedTemporaryFile(dir=ve_dir, delete=False) as tmp:
+        tmp.write(sqlite_file)
+        tmp.flush()
+        tmp.close()
+        conn = sqlite3.connect(tmp.name)
+        value = conn.execute(QUERY).fetchall()
+        conn.close()
+    return value
+
+def ingest(data: bytes):
+    return read_sqlite_file(get_sqlite_file(data))
+
+def measure(fn, *args, repeat: int = 5):
+    '''Return (best seconds, peak traced bytes) over `repeat` runs.
+
+    Peak memory is measured with tracemalloc, so it covers Python-side
+    buffers (zip input, decrypted plaintext) but not SQLite's own page cache.
+    '''
+    best = float("inf")
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return best, peak
+
+def bench_ingest(data: bytes, repeat: int = 5):
+    results = {}
+    for name, fn in (("legacy", legacy_ingest), ("in-memory", ingest)):
+        seconds, peak = measure(fn, data, repeat=repeat)
+        results[name] = {"seconds": seconds, "peak_bytes": peak}
+    return results
+
+def bench_raster(data: bytes, backends=("inkscape", "resvg", "chrome"), jobs: int = 10):
+    '''Latency and peak RSS of each rasterizer backend over `jobs` renders.
+
+    The first job of each backend is reported separately as the cold start.
+    Backends that are not installed are reported with their error.
+    '''
+    from raster import RASTERIZERS
+    from render import build_svg
+
+    groups = process_zip(data)
+    results = {}
+    for name in backends:
+        rasterizer = RASTERIZERS[name]()
+        svg = build_svg(groups, font_url=not rasterizer.embed_font)
+        try:
+            timings = []
+            for _ in range(jobs):
+                start = time.perf_counter()
+                rasterizer.rasterize(svg)
+                timings.append(time.perf_counter() - start)
+        except Exception as e:
+            results[name] = {"error": str(e).splitlines()[0]}
+            continue
+        finally:
+            rasterizer.close()
+        results[name] = {
+            "cold_seconds": timings[0],
+            "seconds": statistics.median(timings[1:] or timings),
+            "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "children_max_rss_kib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        }
+    return results
+
+def best_of(fn, *args, repeat: int = 5, setup=None):
+    '''Return {"seconds": best, "median": median} over `repeat` runs of `fn(*args)`.'''
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return {"seconds": min(timings), "median": statistics.median(timings)}
+
+def read_all_rows(data: bytes):
+    '''Every entry of the backup in `read_sqlite_file`'s row format, not only the last workout.'''
+    conn = sqlite3.connect(":memory:")
+    conn.deserialize(get_sqlite_file(data))
+    rows = conn.execute("select entry.time, entry.data, exercise.xlabel, exercise.unit from entry inner join exercise on entry.exercise = exercise._id").fetchall()
+    conn.close()
+    return rows
+
+def bench_process(data: bytes, repeat: int = 5):
+    seconds, peak = measure(process_zip, data, repeat=repeat)
+    sqlite_file = get_sqlite_file(data)
+    # The stages `pipeline.ingest` runs before deciding a backup is worth processing.
+    return {
+        "process_zip": {"seconds": seconds, "peak_bytes": peak},
+        "fingerprint zip": best_of(zip_entry_fingerprint, data, repeat=repeat),
+        "fingerprint header": best_of(lambda: sqlite_change_counter(read_sqlite_header(data)), repeat=repeat),
+        "fingerprint max_time": best_of(max_entry_time, sqlite_file, repeat=repeat),
+    }
+
+def bench_parse(data: bytes, repeat: int = 5):
+    latest = read_sqlite_file(get_sqlite_file(data))
+    history = read_all_rows(data)
+    return {
+        f"latest ({len(latest)})": best_of(parse_data, latest, repeat=repeat),
+        f"history ({len(history)})": best_of(parse_data, history, repeat=repeat),
+    }
+
+def bench_render(data: bytes, repeat: int = 5):
+    from render import build_svg, format_set, subset_font_b64
+
+    groups = process_zip(data)
+    history = parse_data(read_all_rows(data))
+
+    def format_all(unit):
+        for group in history:
+            format_set(group, unit)
+
+    results = {f"format_set {unit}": best_of(format_all, unit, repeat=repeat) for unit in ("native", "kg", "lbs")}
+    results["build_svg"] = best_of(build_svg, groups, repeat=repeat)
+    results["build_svg uncached font"] = best_of(build_svg, groups, repeat=repeat, setup=subset_font_b64.cache_clear)
+    return results
+
+def bench_snapshot(data: bytes, repeat: int = 5):
+    '''Writing and opening the data snapshot against the pickle it replaced,
+    for the latest workout and for every set in the backup.'''
+    import pickle
+    import snapshot
+
+    results = {}
+    with TemporaryDirectory() as tmp:
+        for name, groups in (("latest", process_zip(data)), ("history", parse_data(read_all_rows(data)))):
+            path, pickle_path = os.path.join(tmp, f"{name}.snapshot"), os.path.join(tmp, f"{name}.pickle")
+            snapshot.write(path, groups)
+            with open(pickle_path, "wb") as f:
+                pickle.dump(groups, f)
+
+            def load_pickle():
+                with open(pickle_path, "rb") as f:
+                    return pickle.load(f)
+
+            seconds, peak = measure(load_pickle, repeat=repeat)
+            results[f"{name} pickle load"] = {"seconds": seconds, "peak_bytes": peak, "file_bytes": os.path.getsize(pickle_path)}
+            seconds, peak = measure(snapshot.Snapshot, path, repeat=repeat)
+            results[f"{name} snapshot open"] = {"seconds": seconds, "peak_bytes": peak, "file_bytes": os.path.getsize(path)}
+            results[f"{name} snapshot decode"] = best_of(lambda: snapshot.Snapshot(path).to_groups(), repeat=repeat)
+            results[f"{name} snapshot write"] = best_of(snapshot.write, path, groups, repeat=repeat)
+    return results
+
+def bench_export(data: bytes, repeat: int = 5):
+    '''Exporting every set of the backup, in each supported format.
+
+    Each export is read back and its row count checked, Parquet through
+    pyarrow, so a writer producing a broken file fails the run.
+    '''
+    import io
+    import export
+    import history
+
+    results = {}
+    with TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "history.db")
+        history.update_history(get_sqlite_file(data), path)
+        with contextlib.closing(history.connect_readonly(path)) as conn:
+            rows = conn.execute("select count(*) from entry").fetchone()[0]
+
+        for format in export.FORMATS:
+            if not export.supported(format):
+                continue
+            output = b"".join(export.export(format, path))
+            if format == "parquet":
+                import pyarrow.parquet as pq
+                exported = pq.read_table(io.BytesIO(output)).num_rows
+            else:
+                exported = output.count(b"\n") - (format == "csv")
+            if exported != rows:
+                raise AssertionError(f"{format} export has {exported} rows, history has {rows}")
+
+            seconds, peak = measure(lambda: sum(len(chunk) for chunk in export.export(format, path)), repeat=repeat)
+            results[format] = {"seconds": seconds, "peak_bytes": peak, "file_bytes": len(output)}
+    return results
+
+@contextlib.contextmanager
+def scratch_dir():
+    '''Run inside a temporary working directory so benchmarks never touch the
+    real data snapshot, cards/ or state; the template and fonts are linked in.'''
+    here = os.getcwd()
+    with TemporaryDirectory() as tmp:
+        for name in ("template.svg", "static"):
+            os.symlink(os.path.join(here, name), os.path.join(tmp, name))
+        os.chdir(tmp)
+        try:
+            yield tmp
+        finally:
+            os.chdir(here)
+
+def bench_endpoints(data: bytes, backend: str = "resvg", repeat: int = 20):
+    '''Latency of the card endpoints through the Flask test client.
+
+    Needs the app's environment (.env) as `app` is imported. The fallback
+    path renders from the data snapshot before any artifact exists; the artifact
+    paths serve what `build_artifacts` wrote with the given rasterizer.
+    '''
+    from raster import get_rasterizer
+
+    groups = process_zip(data)
+    results = {}
+    with scratch_dir():
+        import app as flask_app
+        from artifacts import build_artifacts
+        from render import store_data
+
+        client = flask_app.app.test_client()
+        store_data(groups)
+        etag = client.get("/card.svg").headers["ETag"].strip('"')
+        results["card.svg fallback"] = best_of(client.get, "/card.svg", repeat=repeat)
+        results["card.svg fallback 304"] = best_of(
+            lambda: client.get("/card.svg", headers={"If-None-Match": f'"{etag}"'}), repeat=repeat)
+
+        try:
+            manifest = build_artifacts(groups, get_rasterizer(backend))
+        except Exception as e:
+            results["artifacts"] = {"error": str(e).splitlines()[0]}
+            return results
+        svg = manifest["cards"]["native"]["svg"]
+        for name, path, headers in (
+            ("card.svg", "/card.svg", {}),
+            ("card.svg br", "/card.svg", {"Accept-Encoding": "br"}),
+            ("card.png", "/card.png", {}),
+            ("card.png?unit=lbs", "/card.png?unit=lbs", {}),
+            ("cards/<svg> br", f"/cards/{svg}", {"Accept-Encoding": "br"}),
+        ):
+            results[name] = best_of(lambda: client.get(path, headers=headers).close(), repeat=repeat)
+    return results
+
+def python(*args: str) -> subprocess.CompletedProcess:
+    # A fresh interpreter that finds this directory's modules from any cwd.
+    path = os.pathsep.join(filter(None, (os.path.dirname(os.path.abspath(__file__)), os.environ.get("PYTHONPATH"))))
+    return subprocess.run([sys.executable, *args], capture_output=True, text=True, env={**os.environ, "PYTHONPATH": path})
+
+def import_times(module: str) -> dict:
+    '''Cumulative seconds of `module` and of each module it imports directly,
+    from a fresh interpreter running `python -X importtime`.'''
+    result = python("-X", "importtime", "-c", f"import {module}")
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    # Imports are listed after everything they import, indented by depth.
+    children = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children[name.strip()] = int(cumulative) / 1e6
+        elif depth == 0:
+            if name.strip() == module:
+                return {module: int(cumulative) / 1e6, **children}
+            children = {}
+    raise RuntimeError(f"{module} missing from -X importtime output")
+
+def bench_startup(data: bytes, repeat: int = 5, module: str = "app", top: int = 8):
+    '''Cold start of a worker: wall time of a fresh interpreter importing
+    `module` (against a bare interpreter), and the slowest direct imports.
+
+    Runs in a scratch directory, as importing `app` creates its databases.
+    '''
+    with scratch_dir():
+        results = {
+            "interpreter": best_of(python, "-c", "pass", repeat=repeat),
+            f"import {module}": best_of(python, "-c", f"import {module}", repeat=repeat),
+        }
+        runs = [import_times(module) for _ in range(repeat)]
+    best = {name: min(run.get(name, float("inf")) for run in runs) for name in runs[0] if name != module}
+    for name in sorted(best, key=best.get, reverse=True)[:top]:
+        results[f"  {name}"] = {"seconds": best[name], "median": statistics.median(run.get(name, best[name]) for run in runs)}
+    return results
+
+SUITES = {
+    "ingest": bench_ingest,
+    "process": bench_process,
+    "parse": bench_parse,
+    "render": bench_render,
+    "snapshot": bench_snapshot,
+    "export": bench_export,
+    "endpoints": bench_endpoints,
+    "raster": bench_raster,
+    "startup": bench_startup,
+}
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+def save_results(path: str, source: dict, results: dict):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "source": source,
+            "suites": results,
+        }, f, indent=2)
+
+def compare_results(baseline_path: str, results: dict):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"compared with {baseline_path} ({baseline.get('revision') or 'unknown revision'}, {baseline['time']})")
+    regressions = 0
+    for suite, suite_results in results.items():
+        for name, r in suite_results.items():
+            before = baseline["suites"].get(suite, {}).get(name, {})
+            if "seconds" not in r or "seconds" not in before:
+                continue
+            ratio = r["seconds"] / before["seconds"]
+            flag = "  REGRESSION" if ratio > REGRESSION_THRESHOLD else ""
+            regressions += bool(flag)
+            print(f"  {suite}/{name:<28} {before['seconds'] * 1000:9.2f} ms -> {r['seconds'] * 1000:9.2f} ms  x{ratio:.2f}{flag}")
+    return regressions
+
+def print_results(title: str, results: dict):
+    print(title)
+    for name, r in results.items():
+        if "error" in r:
+            print(f"  {name:<28} unavailable: {r['error']}")
+        elif "peak_bytes" in r:
+            size = f"  {r['file_bytes'] / 1024:8.1f} KiB file" if "file_bytes" in r else ""
+            print(f"  {name:<28} {r['seconds'] * 1000:9.2f} ms  {r['peak_bytes'] / 1024 / 1024:8.2f} MiB peak{size}")
+        elif "max_rss_kib" in r:
+            print(f"  {name:<28} {r['seconds'] * 1000:9.2f} ms  (cold {r['cold_seconds'] * 1000:.0f} ms)  "
+                  f"rss {r['max_rss_kib'] / 1024:.0f} MiB, children {r['children_max_rss_kib'] / 1024:.0f} MiB")
+        else:
+            print(f"  {name:<28} {r['seconds'] * 1000:9.2f} ms  (median {r['median'] * 1000:.2f} ms)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GymRun benchmarks")
+    parser.add_argument("suites", nargs="+", choices=SUITES, metavar="suite", help=f"one or more of {', '.join(SUITES)}")
+    parser.add_argument("--zip", help="path to a gymapp.zip backup, a synthetic one is generated otherwise")
+    parser.add_argument("--size", choices=synth.SIZES, default="year", help="size of the synthetic backup")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--backend", action="append", help="rasterizer backend(s) for the raster and endpoints suites")
+    parser.add_argument("--save", help="write results as JSON to this path")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    if args.zip:
+        with open(args.zip, "rb") as f:
+            data = f.read()
+        source = {"zip": args.zip}
+    else:
+        data = synth.generate_zip(synth.SIZES[args.size], args.seed)
+        source = {"size": args.size, "seed": args.seed}
+    source["bytes"] = len(data)
+
+    results = {}
+    for suite in args.suites:
+        if suite == "raster":
+            results[suite] = bench_raster(data, args.backend or ["inkscape", "resvg", "chrome"], args.repeat)
+        elif suite == "endpoints":
+            results[suite] = bench_endpoints(data, (args.backend or ["resvg"])[0], max(args.repeat, 20))
+        else:
+            results[suite] = SUITES[suite](data, repeat=args.repeat)
+        print_results(f"{suite} ({', '.join(f'{k}={v}' for k, v in source.items())})", results[suite])
+
+    if args.save:
+        save_results(args.save, source, results)
+    if args.compare:
+        raise SystemExit(1 if compare_results(args.compare, results) else 0)
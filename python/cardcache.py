@@ -0,0 +1,113 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+# Rendered historical cards, see `render.get_workout_card`.
+CARD_CACHE_BYTES = int(os.environ.get("CARD_CACHE_BYTES", str(32 * 1024 * 1024)))
+# Optional second tier on disk, shared by all workers; empty disables it.
+CARD_CACHE_DIR = os.environ.get("CARD_CACHE_DIR", "")
+CARD_CACHE_DISK_BYTES = int(os.environ.get("CARD_CACHE_DISK_BYTES", str(256 * 1024 * 1024)))
+
+class MemoryLRU:
+    '''Least recently used bytes values, bounded by their total size.'''
+
+    def __init__(self, max_bytes: int = CARD_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items: OrderedDict[Hashable, bytes] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+class DiskLRU:
+    '''Bytes values in `directory`, one file per key, evicted by access time (mtime).'''
+
+    def __init__(self, directory: str, max_bytes: int = CARD_CACHE_DISK_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: Hashable) -> str:
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return value
+
+    def put(self, key: Hashable, value: bytes):
+        path = self.path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(value)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+class CardCache:
+    '''Memory LRU in front of an optional disk LRU; disk hits are promoted.'''
+
+    def __init__(self, memory: MemoryLRU, disk: Optional[DiskLRU] = None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        return value
+
+    def put(self, key: Hashable, value: bytes):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+def default_cache() -> CardCache:
+    return CardCache(MemoryLRU(), DiskLRU(CARD_CACHE_DIR) if CARD_CACHE_DIR else None)
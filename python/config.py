@@ -0,0 +1,23 @@
+import os
+from functools import cache
+
+from dotenv import load_dotenv
+
+class ConfigError(Exception):
+    pass
+
+@cache
+def load():
+    load_dotenv()
+
+def require(name: str, feature: str) -> str:
+    '''Setting `name`, read when `feature` is first used.
+
+    Settings are looked up on demand rather than at import, so a deployment
+    only has to configure the backup source and post targets it uses.
+    '''
+    load()
+    value = os.environ.get(name)
+    if not value:
+        raise ConfigError(f"{name} must be set to use {feature}, see .env.example")
+    return value
@@ -0,0 +1,62 @@
+import logging
+import threading
+import time
+from typing import Callable, Generic, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# Tokens are never handed out with less than this many seconds left.
+EXPIRY_MARGIN = 300
+# Inside this window before expiry, a refresh starts in the background.
+REFRESH_AHEAD = 900
+
+logger = logging.getLogger('gunicorn.error')
+
+class ExpiringValue(Generic[T]):
+    '''Caches the result of `fetch`, which returns (value, expires_at epoch seconds).
+
+    The value is served from memory until shortly before it expires. Once it
+    enters the `refresh_ahead` window, one background thread fetches a
+    replacement while callers keep getting the current value; only an
+    empty or nearly expired cache makes callers wait.
+    '''
+
+    def __init__(self, fetch: Callable[[], Tuple[T, float]],
+                 margin: float = EXPIRY_MARGIN, refresh_ahead: float = REFRESH_AHEAD):
+        self.fetch = fetch
+        self.margin = margin
+        self.refresh_ahead = refresh_ahead
+        self.value: Optional[T] = None
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def refresh(self) -> T:
+        value, expires_at = self.fetch()
+        self.value, self.expires_at = value, expires_at
+        return value
+
+    def _background_refresh(self):
+        try:
+            with self.lock:
+                self.refresh()
+        except Exception as e:
+            logger.error(f"background credential refresh failed: {e}")
+        finally:
+            self.refreshing = False
+
+    def get(self) -> T:
+        remaining = self.expires_at - time.time()
+        if self.value is not None and remaining > self.margin:
+            if remaining < self.refresh_ahead and not self.refreshing:
+                self.refreshing = True
+                threading.Thread(target=self._background_refresh, daemon=True).start()
+            return self.value
+        with self.lock:
+            # Another caller may have refreshed while we waited for the lock.
+            if self.value is not None and self.expires_at - time.time() > self.margin:
+                return self.value
+            return self.refresh()
+
+    def invalidate(self):
+        self.value, self.expires_at = None, 0.0
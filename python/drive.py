@@ -1,88 +1,248 @@
+import asyncio
+import json
 import os
 import random
-import shelve
+import threading
 import time
-from dotenv import load_dotenv
-import gpsoauth
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
-from google.api_core.client_options import ClientOptions
+from typing import Dict, List, Optional, Tuple
 
+from config import require
+from credentials import ExpiringValue
+from httpclient import close_session, get_session
+import metrics
+import state
 
-load_dotenv()
-GOOGLE_MASTER_TOKEN = os.environ["GOOGLE_MASTER_TOKEN"]
-GOOGLE_USERNAME = os.environ["GOOGLE_USERNAME"]
-SHELVE_PATH = "shelve.db"
 CHANNEL_ID = "gymrun_channel_watch"
+# Point at a stand-in server (see fake_drive.py) to run without Google Drive.
+DRIVE_BASE_URL = os.environ.get("DRIVE_BASE_URL", "https://www.googleapis.com")
+# GymRun's Google Drive backup is the bare database in the app data folder.
+FILE_NAME = "gymapp.db"
+FILE_FIELDS = "id, name, modifiedTime, md5Checksum, size"
+PAGE_SIZE = 100
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Drive caps change channels at a week.
+CHANNEL_LIFETIME = 7 * 24 * 3600
+# Per-tenant Google account, {"username": ..., "master_token": ...}. Only the
+# default tenant may instead use GOOGLE_USERNAME/GOOGLE_MASTER_TOKEN.
+CREDENTIALS_PATH = "google_credentials.json"
 
 app_id = "com.imperon.android.gymapp"
 app_signature = "c74f618b352df7d73627daa2f010c4bfc79faa21"
 device_id = "0242AC110002"
 
-def store(key, channel):
-    with shelve.open(SHELVE_PATH) as db:
-        db[key] = channel
-        db.sync()
-
-def get(key):
-    with shelve.open(SHELVE_PATH) as db:
-        if key not in db:
-            return None
-        return db[key]
-
-def get_token():
-    auth = gpsoauth.perform_oauth(
-        GOOGLE_USERNAME,
-        GOOGLE_MASTER_TOKEN,
-        device_id,
-        "oauth2:https://www.googleapis.com/auth/drive.appdata https://www.googleapis.com/auth/drive.file",
-        app_id,
-        app_signature,
-    )
-    # {'issueAdvice': 'auto', 'Expiry': '(unix timestamp)', 'ExpiresInDurationSec': '3599', 
-    # 'storeConsentRemotely': '0', 'isTokenSnowballed': '0', 'grantedScopes': 'https://www.googleapis.com/auth/drive.appdata', 
-    # 'Auth': '(token)'}
-    return auth["Auth"]
-
-def get_service():
-    creds = Credentials(get_token())
-    service = build('drive', 'v3', credentials=creds, client_options=ClientOptions(scopes=["https://www.googleapis.com/auth/drive.appdata", "https://www.googleapis.com/auth/drive.file"]))
-    return service
-
-def get_file_id(service):
-    results = service.files().list(spaces="appDataFolder", pageSize=10, fields="nextPageToken, files(id, name, modifiedTime)").execute()
-    for f in results["files"]:
-        if f["name"] == "gymapp.db":
-            return f["id"]
-
-def get_file(service, file_id):
-    data = service.files().get_media(fileId=file_id).execute()
+class GoogleCredential:
+    '''Drive access tokens of one Google account, minted from its master token.'''
+
+    def __init__(self, credentials_path: str = CREDENTIALS_PATH):
+        if os.path.exists(credentials_path):
+            with open(credentials_path) as f:
+                account = json.load(f)
+            self.username, self.master_token = account["username"], account["master_token"]
+        elif credentials_path == CREDENTIALS_PATH:
+            self.username = require("GOOGLE_USERNAME", "Google Drive")
+            self.master_token = require("GOOGLE_MASTER_TOKEN", "Google Drive")
+        else:
+            raise FileNotFoundError(f"{credentials_path} is needed to use Google Drive, see README.md")
+        self._token = ExpiringValue(self.fetch_token)
+
+    def fetch_token(self) -> Tuple[str, float]:
+        import gpsoauth
+        auth = gpsoauth.perform_oauth(
+            self.username,
+            self.master_token,
+            device_id,
+            "oauth2:https://www.googleapis.com/auth/drive.appdata https://www.googleapis.com/auth/drive.file",
+            app_id,
+            app_signature,
+        )
+        # {'issueAdvice': 'auto', 'Expiry': '(unix timestamp)', 'ExpiresInDurationSec': '3599', 
+        # 'storeConsentRemotely': '0', 'isTokenSnowballed': '0', 'grantedScopes': 'https://www.googleapis.com/auth/drive.appdata', 
+        # 'Auth': '(token)'}
+        return auth["Auth"], float(auth.get("Expiry") or time.time() + int(auth.get("ExpiresInDurationSec", 3599)))
+
+    def get_token(self) -> str:
+        return self._token.get()
+
+    def invalidate(self):
+        self._token.invalidate()
+
+_credentials: Dict[str, GoogleCredential] = {}
+_credentials_lock = threading.Lock()
+
+def get_credential(credentials_path: str = CREDENTIALS_PATH) -> GoogleCredential:
+    with _credentials_lock:
+        cred = _credentials.get(credentials_path)
+        if cred is None:
+            cred = _credentials[credentials_path] = GoogleCredential(credentials_path)
+        return cred
+
+download_stats = {"checks": 0, "changes": 0, "downloads": 0, "skipped": 0, "bytes_downloaded": 0}
+
+async def request(cred: GoogleCredential, method: str, path: str, params: Optional[Dict] = None, json: Optional[Dict] = None) -> Dict:
+    token = await asyncio.to_thread(cred.get_token)
+    async with get_session().request(method, f"{DRIVE_BASE_URL}/drive/v3/{path}", params=params, json=json,
+                                     headers={"Authorization": f"Bearer {token}"}) as response:
+        if response.status == 401:
+            cred.invalidate()
+        if response.status not in (200, 204):
+            raise Exception(f"Drive {method} {path} failed: {response.status} {await response.text()}")
+        return await response.json() if response.status == 200 else {}
+
+async def list_files(cred: GoogleCredential, query: str) -> List[Dict]:
+    '''All files in the app data folder matching `query`, following every page.'''
+    files, page_token = [], None
+    while True:
+        params = {"spaces": "appDataFolder", "q": query, "pageSize": PAGE_SIZE,
+                  "fields": f"nextPageToken, files({FILE_FIELDS})"}
+        if page_token:
+            params["pageToken"] = page_token
+        result = await request(cred, "GET", "files", params)
+        files.extend(result.get("files", []))
+        page_token = result.get("nextPageToken")
+        if not page_token:
+            return files
+
+async def find_file(cred: GoogleCredential) -> Optional[Dict]:
+    files = await list_files(cred, f"name = '{FILE_NAME}' and trashed = false")
+    # Keep the most recent if the app ever left more than one behind.
+    return max(files, key=lambda f: f.get("modifiedTime", ""), default=None)
+
+async def get_start_page_token(cred: GoogleCredential) -> str:
+    result = await request(cred, "GET", "changes/startPageToken")
+    return result["startPageToken"]
+
+async def list_changes(cred: GoogleCredential, page_token: str) -> Tuple[List[Dict], str]:
+    '''Changes in the app data folder since `page_token`, and the token to resume from next time.'''
+    changes = []
+    while True:
+        result = await request(cred, "GET", "changes", {
+            "pageToken": page_token, "spaces": "appDataFolder", "pageSize": PAGE_SIZE,
+            "fields": f"nextPageToken, newStartPageToken, changes(fileId, removed, file({FILE_FIELDS}))",
+        })
+        changes.extend(result.get("changes", []))
+        if "newStartPageToken" in result:
+            return changes, result["newStartPageToken"]
+        page_token = result["nextPageToken"]
+
+def file_version(file: Optional[Dict]) -> Optional[Dict]:
+    if file is None:
+        return None
+    return {key: file.get(key) for key in ("id", "md5Checksum", "modifiedTime", "size")}
+
+async def download(cred: GoogleCredential, file: Dict) -> bytearray:
+    # Stream into one buffer of the advertised size, as onedrive.download does.
+    data = bytearray(int(file.get("size") or 0))
+    offset = 0
+    token = await asyncio.to_thread(cred.get_token)
+    async with get_session().get(f"{DRIVE_BASE_URL}/drive/v3/files/{file['id']}", params={"alt": "media"},
+                                 headers={"Authorization": f"Bearer {token}"}) as response:
+        if response.status != 200:
+            raise Exception(f"Failed to download {file['id']}: {response.status}")
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            data[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+    del data[offset:]
+    return data
+
+async def current_file(cred: GoogleCredential, store: state.StateStore) -> Optional[Dict]:
+    '''The backup file, found through the changes feed once a page token is stored.
+
+    The first call lists the folder; later calls only read the changes since
+    the stored token and return the remembered file when it did not change.
+    '''
+    # The state store is SQLite; keep it off the event loop.
+    page_token = await asyncio.to_thread(store.get, "drive_page_token")
+    file = await asyncio.to_thread(store.get, "drive_file")
+    if page_token is None or file is None:
+        # Take the token first so changes made while listing are seen next time.
+        page_token = await get_start_page_token(cred)
+        file = await find_file(cred)
+    else:
+        changes, page_token = await list_changes(cred, page_token)
+        download_stats["changes"] += len(changes)
+        for change in changes:
+            changed = change.get("file") or {}
+            gone = change.get("removed") or changed.get("trashed")
+            if file is not None and change.get("fileId") == file["id"]:
+                file = None if gone else changed
+            elif not gone and changed.get("name") == FILE_NAME and changed.get("modifiedTime", "") > (file or {}).get("modifiedTime", ""):
+                file = changed
+        if file is None:
+            file = await find_file(cred)
+    await asyncio.to_thread(store.set, "drive_file", file)
+    await asyncio.to_thread(store.set, "drive_page_token", page_token)
+    return file
+
+async def get_zip_if_changed(last_version: Optional[Dict] = None, store: Optional[state.StateStore] = None,
+                             cred: Optional[GoogleCredential] = None) -> Tuple[Optional[bytearray], Optional[Dict]]:
+    '''Same contract as `onedrive.get_zip_if_changed`: download the backup unless
+    its id/md5/modifiedTime/size match `last_version`.
+
+    Returns (backup bytes or None when unchanged, current version).
+    '''
+    store = store or state.get_store()
+    cred = cred or get_credential()
+    with metrics.timer("check"):
+        file = await current_file(cred, store)
+    if file is None:
+        raise Exception(f"{FILE_NAME} not found in the Drive app data folder")
+    version = file_version(file)
+    download_stats["checks"] += 1
+    if last_version == version:
+        download_stats["skipped"] += 1
+        return None, version
+    with metrics.timer("download"):
+        data = await download(cred, file)
+    metrics.count_bytes("download", "in", data)
+    download_stats["downloads"] += 1
+    download_stats["bytes_downloaded"] += len(data)
+    return data, version
+
+async def get_zip(cred: Optional[GoogleCredential] = None) -> bytearray:
+    data, _ = await get_zip_if_changed(cred=cred)
     return data
 
-def subscribe(service, url):
-    file_id = get_file_id(service)
-    body = {
-        'kind': 'api#channel',
-        'resourceId': file_id,
-        'id': f"{CHANNEL_ID}{random.randint(0, 100000)}",
-        'token': file_id,
-        'type': 'web_hook',
-        'address': url,
-        'expiration': int(time.time() + 24*60*60) * 1000 # 1 day
-    }
-    channel = service.files().watch(fileId=file_id, body=body).execute()
-    store("channel", channel)
+async def subscribe(url: str, token: str = "", store: Optional[state.StateStore] = None,
+                    cred: Optional[GoogleCredential] = None) -> Dict:
+    '''Watch the changes feed; notifications carry `token` in X-Goog-Channel-Token.'''
+    store = store or state.get_store()
+    cred = cred or get_credential()
+    page_token = await asyncio.to_thread(store.get, "drive_page_token") or await get_start_page_token(cred)
+    channel = await request(cred, "POST", "changes/watch", {"pageToken": page_token, "spaces": "appDataFolder"}, {
+        "kind": "api#channel",
+        "id": f"{CHANNEL_ID}{random.randint(0, 100000)}",
+        "token": token,
+        "type": "web_hook",
+        "address": url,
+        "expiration": int(time.time() + CHANNEL_LIFETIME) * 1000,
+    })
+    await asyncio.to_thread(store.set, "channel", channel)
     return channel
 
-def unsubscribe(service):
-    channel = get("channel")
+async def unsubscribe(store: Optional[state.StateStore] = None, cred: Optional[GoogleCredential] = None):
+    store = store or state.get_store()
+    channel = await asyncio.to_thread(store.get, "channel")
     if channel:
-        service.channels().stop(body=channel).execute()
-        store("channel", None)
+        await request(cred or get_credential(), "POST", "channels/stop", json={"id": channel["id"], "resourceId": channel["resourceId"]})
+        await asyncio.to_thread(store.set, "channel", None)
+
+async def resubscribe(url: str, token: str = "", store: Optional[state.StateStore] = None,
+                      cred: Optional[GoogleCredential] = None) -> Dict:
+    await unsubscribe(store, cred)
+    return await subscribe(url, token, store, cred)
 
-def resubscribe(service, url):
-    unsubscribe(service)
-    subscribe(service, url)
+async def main(cred: Optional[GoogleCredential] = None):
+    from gymrun import process_zip
+    data = await get_zip(cred)
+    print("process_zip", process_zip(data))
+    print("download_stats", download_stats)
+    await close_session()
 
 if __name__ == "__main__":
-    pass
+    # `python drive.py <tenant>` checks that tenant's Google account.
+    import sys
+    from tenants import get_tenant
+    tenant = get_tenant(sys.argv[1]) if len(sys.argv) > 1 else get_tenant()
+    if tenant is None:
+        sys.exit(f"no such tenant: {sys.argv[1]}")
+    asyncio.run(main(get_credential(tenant.path(CREDENTIALS_PATH))))
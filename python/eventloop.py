@@ -0,0 +1,135 @@
+import asyncio
+import atexit
+import functools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from httpclient import close_session
+import metrics
+
+T = TypeVar("T")
+
+# Worker processes for the CPU-bound pipeline steps (decrypt, parse, render, rasterize).
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", "2"))
+# Imported once by the fork server, so workers start warm and never import the app.
+CPU_PRELOAD = ["pipeline"]
+
+def _call(fn: Callable[..., T], args: tuple, kwargs: dict) -> tuple:
+    # Runs in a CPU worker: metrics recorded there go back with the result.
+    try:
+        result = fn(*args, **kwargs)
+    except BaseException as e:
+        e.worker_metrics = metrics.drain()
+        raise
+    return result, metrics.drain()
+
+class EventLoop:
+    '''One asyncio loop per process.
+
+    Under an ASGI server (see asgi.py) it is the server's own loop; otherwise
+    a background thread runs one. Flask views and job handlers are
+    synchronous; they hand coroutines to `run` instead of starting a loop
+    per call with `asyncio.run`, so every Graph and Drive request shares the
+    loop's pooled aiohttp session. CPU-bound steps go through `run_cpu` to a
+    bounded pool of worker processes, so they run in parallel instead of
+    taking turns on the GIL, and the loop stays free for I/O meanwhile.
+    '''
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None, cpu_workers: int = CPU_WORKERS):
+        self.cpu_workers = cpu_workers
+        self.cpu: Optional[ProcessPoolExecutor] = None
+        self.cpu_lock = threading.Lock()
+        self.thread = None
+        self.loop = loop
+        if loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name="event-loop", daemon=True)
+            self.thread.start()
+
+    def run(self, coro: Awaitable[T], timeout: Optional[float] = None) -> T:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def get_cpu(self) -> ProcessPoolExecutor:
+        # Started on first use: serving cards never needs it.
+        with self.cpu_lock:
+            if self.cpu is None:
+                # Forked from a single-threaded server rather than from this
+                # process and its loop, job and request threads.
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(CPU_PRELOAD)
+                self.cpu = ProcessPoolExecutor(self.cpu_workers, mp_context=context)
+            return self.cpu
+
+    async def run_cpu(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        try:
+            result, recorded = await self.loop.run_in_executor(self.get_cpu(), functools.partial(_call, fn, args, kwargs))
+        except BaseException as e:
+            metrics.merge(getattr(e, "worker_metrics", None))
+            raise
+        metrics.merge(recorded)
+        return result
+
+    async def aclose(self):
+        await close_session()
+        if self.cpu is not None:
+            self.cpu.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        if self.thread is None:
+            # The ASGI server owns the loop and closes it through asgi.py.
+            return
+        try:
+            self.run(self.aclose(), timeout=5)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(5)
+
+_event_loop: Optional[EventLoop] = None
+_event_loop_lock = threading.Lock()
+
+def _reset_after_fork():
+    # The loop thread and worker pool do not survive a fork (gunicorn --preload).
+    global _event_loop
+    _event_loop = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def get_event_loop() -> EventLoop:
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = EventLoop()
+        return _event_loop
+
+def use_running_loop() -> EventLoop:
+    '''Make the calling coroutine's loop the shared one, e.g. an ASGI server's.
+
+    A loop thread started before, say by a job picked up during startup,
+    is shut down.
+    '''
+    global _event_loop
+    with _event_loop_lock:
+        previous, _event_loop = _event_loop, EventLoop(asyncio.get_running_loop())
+    if previous is not None:
+        threading.Thread(target=previous.close, name="event-loop-close", daemon=True).start()
+    return _event_loop
+
+def run(coro: Awaitable[T], timeout: Optional[float] = None) -> T:
+    '''Run `coro` on the shared loop and wait for its result. Not from the loop itself.'''
+    return get_event_loop().run(coro, timeout)
+
+async def run_cpu(fn: Callable[..., T], *args, **kwargs) -> T:
+    '''From a coroutine on the shared loop, run `fn` in a CPU worker process.
+
+    `fn` must be importable by the workers, as those in pipeline.py are, and
+    its arguments and result must pickle.
+    '''
+    return await get_event_loop().run_cpu(fn, *args, **kwargs)
+
+@atexit.register
+def _close():
+    if _event_loop is not None:
+        _event_loop.close()
@@ -0,0 +1,182 @@
+'''Export every set in history.db as CSV, NDJSON or Parquet.
+
+    python export.py --format csv --since 2024-01-01 -o sets.csv
+    python export.py --format parquet --tenant alice --exercise 3 -o bench.parquet
+
+Rows are read lazily from one cursor and written out in batches, so memory
+stays flat however long the history is. Parquet needs the optional pyarrow.
+'''
+import argparse
+import csv
+import importlib.util
+import io
+import json
+import sqlite3
+import sys
+from datetime import date, datetime, timedelta
+from typing import Iterable, Iterator, Optional, Tuple
+
+from gymrun import display_weight, parse_unit
+import history
+from history import HISTORY_PATH
+
+COLUMNS = ("time", "exercise", "unit", "weight", "reps", "set")
+# Rows per Parquet row group, and bytes of text gathered before a CSV/NDJSON chunk is yielded.
+BATCH_ROWS = 10000
+CHUNK_BYTES = 64 * 1024
+
+# (time, exercise, unit, weight, reps, set) with weights and units as
+# `parse_data` normalizes them; time is local, like the cards.
+Row = Tuple[datetime, str, Optional[str], int, int, int]
+
+def iter_sets(conn: sqlite3.Connection, since: Optional[date] = None, until: Optional[date] = None,
+              exercise: Optional[int] = None) -> Iterator[Row]:
+    '''Sets in time order, filtered in SQL by local date range (inclusive) and exercise id.'''
+    where, params = [], []
+    if since is not None:
+        where.append("e.time >= ?")
+        params.append(int(datetime.combine(since, datetime.min.time()).timestamp()))
+    if until is not None:
+        where.append("e.time < ?")
+        params.append(int(datetime.combine(until + timedelta(days=1), datetime.min.time()).timestamp()))
+    if exercise is not None:
+        where.append("e.exercise = ?")
+        params.append(exercise)
+    cursor = conn.execute("select e.time, x.name, x.unit, e.weight, e.reps, e.set_number from entry e "
+                          "join exercise x on x._id = e.exercise "
+                          f"{'where ' + ' and '.join(where) if where else ''} order by e.time, e._id", params)
+    for time, name, unit, weight, reps, set_number in cursor:
+        unit = parse_unit(unit)
+        yield datetime.fromtimestamp(time), name, unit, display_weight(weight, unit), reps, set_number
+
+def to_csv(rows: Iterable[Row]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for time, *rest in rows:
+        writer.writerow((time.isoformat(), *rest))
+        if buffer.tell() >= CHUNK_BYTES:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+def to_ndjson(rows: Iterable[Row]) -> Iterator[bytes]:
+    chunk = []
+    size = 0
+    for time, *rest in rows:
+        line = json.dumps(dict(zip(COLUMNS, (time.isoformat(), *rest))), ensure_ascii=False) + "\n"
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_BYTES:
+            yield "".join(chunk).encode()
+            chunk, size = [], 0
+    yield "".join(chunk).encode()
+
+class ChunkSink(io.RawIOBase):
+    '''Write-only file collecting what pyarrow writes until it is drained.'''
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def to_parquet(rows: Iterable[Row]) -> Iterator[bytes]:
+    '''One row group per `BATCH_ROWS` sets, yielded as soon as it is written.'''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([("time", pa.timestamp("s")), ("exercise", pa.string()), ("unit", pa.string()),
+                        ("weight", pa.int64()), ("reps", pa.int64()), ("set", pa.int64())])
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+
+    def write(batch):
+        columns = zip(*batch)
+        writer.write_batch(pa.record_batch([pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_ROWS:
+            write(batch)
+            batch = []
+            yield sink.drain()
+    if batch:
+        write(batch)
+    writer.close()
+    yield sink.drain()
+
+# Format -> (writer, MIME type).
+FORMATS = {
+    "csv": (to_csv, "text/csv"),
+    "ndjson": (to_ndjson, "application/x-ndjson"),
+    "parquet": (to_parquet, "application/vnd.apache.parquet"),
+}
+
+def supported(format: str) -> bool:
+    return format in FORMATS and (format != "parquet" or importlib.util.find_spec("pyarrow") is not None)
+
+def export(format: str, path: str = HISTORY_PATH, since: Optional[date] = None, until: Optional[date] = None,
+           exercise: Optional[int] = None) -> Iterator[bytes]:
+    '''Chunks of the history in `format`; the database stays open until the last one.
+
+    The history is opened read-only right away, so a missing one raises
+    FileNotFoundError here rather than being created or failing mid-stream.
+    '''
+    conn = history.connect_readonly(path)
+
+    def chunks():
+        try:
+            yield from FORMATS[format][0](iter_sets(conn, since, until, exercise))
+        finally:
+            conn.close()
+
+    return chunks()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export workout history")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--since", type=date.fromisoformat, help="first day, YYYY-MM-DD")
+    parser.add_argument("--until", type=date.fromisoformat, help="last day, YYYY-MM-DD")
+    parser.add_argument("--exercise", type=int, help="exercise id, as in /analytics/records")
+    parser.add_argument("--tenant", help="export this tenant's history instead of ./history.db")
+    parser.add_argument("-o", "--output", help="file to write, stdout by default")
+    args = parser.parse_args()
+    if not supported(args.format):
+        sys.exit(f"{args.format} export needs pyarrow")
+
+    path = HISTORY_PATH
+    if args.tenant:
+        from tenants import get_tenant
+        tenant = get_tenant(args.tenant)
+        if tenant is None:
+            sys.exit(f"no such tenant: {args.tenant}")
+        path = tenant.path(HISTORY_PATH)
+
+    try:
+        chunks = export(args.format, path, args.since, args.until, args.exercise)
+    except FileNotFoundError:
+        sys.exit(f"no history at {path}")
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
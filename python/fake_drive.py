@@ -0,0 +1,121 @@
+'''Stand-in for the Google Drive v3 endpoints `drive` uses, for offline runs.
+
+Serves a local gymapp.db (or any file) as the backup in the app data folder,
+next to `--filler` older or unrelated files so listings need more than one
+page. Run the app with DRIVE_BASE_URL=http://127.0.0.1:<port>. Replacing the
+file on disk adds an entry to the changes feed like an upload would.
+
+    python fake_drive.py path/to/gymapp.db --port 8767
+'''
+import argparse
+import hashlib
+import os
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+# Same name as drive.FILE_NAME; not imported to keep this free of Google setup.
+FILE_NAME = "gymapp.db"
+FILE_ID = "fake-gymapp-db"
+# Deliberately small so every client has to follow nextPageToken.
+MAX_PAGE_SIZE = 3
+
+stats = {"list_requests": 0, "change_requests": 0, "downloads": 0, "bytes_served": 0, "channels": 0}
+
+def make_app(path: str, filler: int = 5) -> web.Application:
+    # Every other filler file is an old leftover copy of the backup.
+    files = {f"fake-filler-{i}": {"id": f"fake-filler-{i}", "name": FILE_NAME if i % 2 else f"filler-{i}.json",
+                                  "size": "2", "modifiedTime": f"2020-01-{i % 28 + 1:02}T00:00:00.000Z",
+                                  "md5Checksum": hashlib.md5(b"{}").hexdigest()}
+             for i in range(filler)}
+    # Change log; a page token is an index into it.
+    changes = [{"fileId": file_id} for file_id in files]
+    seen = {"mtime": None}
+
+    def backup():
+        st = os.stat(path)
+        if st.st_mtime_ns != seen["mtime"]:
+            with open(path, "rb") as f:
+                md5 = hashlib.md5(f.read()).hexdigest()
+            files[FILE_ID] = {
+                "id": FILE_ID,
+                "name": FILE_NAME,
+                "size": str(st.st_size),
+                "md5Checksum": md5,
+                "modifiedTime": datetime.fromtimestamp(st.st_mtime, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")[:-4] + "Z",
+            }
+            seen["mtime"] = st.st_mtime_ns
+            changes.append({"fileId": FILE_ID})
+        return files[FILE_ID]
+
+    def page(request: web.Request, items: list, start: int):
+        size = min(int(request.query.get("pageSize", MAX_PAGE_SIZE)), MAX_PAGE_SIZE)
+        end = start + size
+        return items[start:end], end if end < len(items) else None
+
+    async def start_page_token(request: web.Request):
+        backup()
+        return web.json_response({"startPageToken": str(len(changes))})
+
+    async def list_changes(request: web.Request):
+        stats["change_requests"] += 1
+        backup()
+        items, next_token = page(request, changes, int(request.query["pageToken"]))
+        body = {"changes": [{**change, "removed": False, "file": files[change["fileId"]]} for change in items]}
+        if next_token is None:
+            body["newStartPageToken"] = str(len(changes))
+        else:
+            body["nextPageToken"] = str(next_token)
+        return web.json_response(body)
+
+    async def list_files(request: web.Request):
+        stats["list_requests"] += 1
+        backup()
+        query = request.query.get("q", "")
+        matching = [f for f in files.values() if "name = " not in query or f"name = '{f['name']}'" in query]
+        items, next_token = page(request, matching, int(request.query.get("pageToken", 0)))
+        body = {"files": items}
+        if next_token is not None:
+            body["nextPageToken"] = str(next_token)
+        return web.json_response(body)
+
+    async def get_file(request: web.Request):
+        file = files.get(request.match_info["id"])
+        if file is None:
+            raise web.HTTPNotFound()
+        if request.query.get("alt") != "media":
+            return web.json_response(file)
+        if file["id"] != FILE_ID:
+            return web.Response(body=b"{}")
+        stats["downloads"] += 1
+        stats["bytes_served"] += os.path.getsize(path)
+        return web.FileResponse(path)
+
+    async def watch(request: web.Request):
+        stats["channels"] += 1
+        body = await request.json()
+        return web.json_response({**body, "resourceId": "fake-changes", "resourceUri": str(request.url)})
+
+    async def stop(request: web.Request):
+        return web.Response(status=204)
+
+    async def get_stats(request: web.Request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_get("/drive/v3/changes/startPageToken", start_page_token)
+    app.router.add_get("/drive/v3/changes", list_changes)
+    app.router.add_post("/drive/v3/changes/watch", watch)
+    app.router.add_get("/drive/v3/files", list_files)
+    app.router.add_get("/drive/v3/files/{id}", get_file)
+    app.router.add_post("/drive/v3/channels/stop", stop)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("file")
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--filler", type=int, default=5, help="older or unrelated files in the app data folder")
+    args = parser.parse_args()
+    web.run_app(make_app(args.file, args.filler), host="127.0.0.1", port=args.port)
@@ -0,0 +1,64 @@
+'''Stand-in for the Microsoft Graph endpoints `onedrive` uses, for offline runs.
+
+Serves a local gymapp.zip as the drive item; run the app with
+GRAPH_BASE_URL=http://127.0.0.1:<port>. Replacing the file on disk changes
+the item's eTag/cTag like an upload would.
+
+    python fake_graph.py path/to/gymapp.zip --port 8765
+'''
+import argparse
+import hashlib
+import os
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+# Same item path as onedrive.ZIP_PATH; not imported to keep this free of MSAL setup.
+ZIP_PATH = "/Apps/GymRun/gymapp.zip"
+
+stats = {"metadata_requests": 0, "downloads": 0, "bytes_served": 0}
+
+def make_app(zip_path: str) -> web.Application:
+    def version():
+        st = os.stat(zip_path)
+        tag = hashlib.sha1(f"{st.st_mtime_ns}-{st.st_size}".encode()).hexdigest()
+        modified = datetime.fromtimestamp(st.st_mtime, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        return st.st_size, tag, modified
+
+    async def item(request: web.Request):
+        stats["metadata_requests"] += 1
+        size, tag, modified = version()
+        return web.json_response({
+            "name": "gymapp.zip",
+            "size": size,
+            "eTag": f'"{{{tag}}},1"',
+            "cTag": f'"c:{{{tag}}},1"',
+            "lastModifiedDateTime": modified,
+            "@microsoft.graph.downloadUrl": str(request.url.with_path("/download/gymapp.zip").with_query(None)),
+        })
+
+    async def download(request: web.Request):
+        stats["downloads"] += 1
+        stats["bytes_served"] += os.path.getsize(zip_path)
+        return web.FileResponse(zip_path)
+
+    async def subscriptions(request: web.Request):
+        body = await request.json()
+        return web.json_response({"id": "fake-subscription", **body}, status=201)
+
+    async def get_stats(request: web.Request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_get(f"/v1.0/drives/me/root:{ZIP_PATH}", item)
+    app.router.add_get("/download/gymapp.zip", download)
+    app.router.add_post("/v1.0/drive/root/subscriptions", subscriptions)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("zip")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    web.run_app(make_app(args.zip), host="127.0.0.1", port=args.port)
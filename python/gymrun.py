@@ -1,11 +1,10 @@
+from array import array
 from dataclasses import dataclass
 from io import BytesIO
-import itertools
-from tempfile import NamedTemporaryFile, TemporaryDirectory
-from typing import List, Tuple, Literal
-from requests.models import Response
+from typing import Dict, Iterable, List, Optional, Tuple, Literal
 import sqlite3
-import pyzipper
+
+import metrics
 from datetime import datetime
 
 @dataclass
@@ -23,53 +22,213 @@ def lbs_to_kg(lbs: float) -> float:
 def kg_to_lbs(kg: float) -> float:
     return kg * 2.20462262
 
-def get_sqlite_file(data: bytes) -> bytes:
-    with TemporaryDirectory() as ve_dir, NamedTemporaryFile(dir=ve_dir, delete=False) as tmp:
-        tmp.write(data)
-        tmp.flush()
-        tmp.close()
-        with pyzipper.AESZipFile(tmp.name) as zf:
-            zf.setpassword(b"13-ImPeRiOn,90#")
-            return zf.read("gymapp.db")
+ZIP_PASSWORD = b"13-ImPeRiOn,90#"
+# Decrypt in bounded chunks so only the plaintext buffer is held in full.
+CHUNK_SIZE = 64 * 1024
+SQLITE_HEADER = b"SQLite format 3\x00"
+SQLITE_HEADER_SIZE = 100
 
-def read_sqlite_file(sqlite_file: bytes):
-    with TemporaryDirectory() as ve_dir, NamedTemporaryFile(dir=ve_dir, delete=False) as tmp:
-        tmp.write(sqlite_file)
-        tmp.flush()
-        tmp.close()
-        value = []
-        conn =sqlite3.connect(tmp.name)
-        c = conn.cursor()
-        c.execute("select entry.time, entry.data, exercise.xlabel, exercise.unit from entry inner join exercise on entry.exercise = exercise._id where entry.time >= (select time_start from workout order by time_start desc limit 1) and entry.time <= (select time_end from workout order by time_start desc limit 1);")
-        value = c.fetchall()
-        c.close()
+@metrics.timed("decrypt")
+def get_sqlite_file(data: bytes) -> bytearray:
+    metrics.count_bytes("decrypt", "in", data)
+    # Google Drive backups are the bare database rather than a zip.
+    if data[:len(SQLITE_HEADER)] == SQLITE_HEADER:
+        return data if isinstance(data, bytearray) else bytearray(data)
+    # Imported here: most importers of this module only need `Exercise`.
+    import pyzipper
+    with pyzipper.AESZipFile(BytesIO(data)) as zf:
+        zf.setpassword(ZIP_PASSWORD)
+        info = zf.getinfo("gymapp.db")
+        sqlite_file = bytearray(info.file_size)
+        view = memoryview(sqlite_file)
+        offset = 0
+        with zf.open(info) as f:
+            while chunk := f.read(CHUNK_SIZE):
+                view[offset:offset + len(chunk)] = chunk
+                offset += len(chunk)
+        view.release()
+        del sqlite_file[offset:]
+        metrics.count_bytes("decrypt", "out", sqlite_file)
+        return sqlite_file
+
+# Cheap fingerprints of a backup, from cheapest to dearest, that let
+# `app.process_file` stop before the full pipeline when nothing changed.
+
+def zip_entry_fingerprint(data: bytes) -> Optional[Tuple[int, int, int]]:
+    '''(CRC, size, compressed size) of gymapp.db from the zip directory.
+
+    None when that proves nothing: for a bare database, or for AES entries
+    in the AE-2 format, which store a zero CRC.
+    '''
+    if data[:len(SQLITE_HEADER)] == SQLITE_HEADER:
+        return None
+    import pyzipper
+    with pyzipper.AESZipFile(BytesIO(data)) as zf:
+        info = zf.getinfo("gymapp.db")
+    if info.CRC == 0:
+        return None
+    return info.CRC, info.file_size, info.compress_size
+
+def read_sqlite_header(data: bytes) -> bytes:
+    '''The 100-byte database header, decrypting only the start of the zip entry.'''
+    if data[:len(SQLITE_HEADER)] == SQLITE_HEADER:
+        return bytes(data[:SQLITE_HEADER_SIZE])
+    import pyzipper
+    with pyzipper.AESZipFile(BytesIO(data)) as zf:
+        zf.setpassword(ZIP_PASSWORD)
+        with zf.open("gymapp.db") as f:
+            return f.read(SQLITE_HEADER_SIZE)
+
+def sqlite_change_counter(header: bytes) -> Optional[Tuple[int, int]]:
+    '''(file change counter, page count) from a database header.
+
+    None when the counter is not maintained: never written (0), stale
+    (its "version-valid-for" copy differs) or in WAL mode.
+    '''
+    counter = int.from_bytes(header[24:28], "big")
+    if counter == 0 or header[92:96] != header[24:28] or header[18] == 2 or header[19] == 2:
+        return None
+    return counter, int.from_bytes(header[28:32], "big")
+
+@metrics.timed("query")
+def max_entry_time(sqlite_file: bytes) -> Optional[int]:
+    conn = open_sqlite(sqlite_file)
+    try:
+        return conn.execute("select max(time) from entry").fetchone()[0]
+    finally:
         conn.close()
+
+def open_sqlite(sqlite_file: bytes) -> sqlite3.Connection:
+    conn = sqlite3.connect(":memory:")
+    conn.deserialize(sqlite_file)
+    return conn
+
+@metrics.timed("query")
+def read_sqlite_file(sqlite_file: bytes):
+    conn = open_sqlite(sqlite_file)
+    c = conn.cursor()
+    c.execute("select entry.time, entry.data, exercise.xlabel, exercise.unit from entry inner join exercise on entry.exercise = exercise._id where entry.time >= (select time_start from workout order by time_start desc limit 1) and entry.time <= (select time_end from workout order by time_start desc limit 1);")
+    value = c.fetchall()
+    c.close()
+    conn.close()
     return value
 
-def parse_data(data: List[Tuple[int, str, str, str]]) -> List[List[Exercise]]:
-    result = []
+# Slots of the `entry.data` properties we use: 3 = set, 4 = weight (kg), 5/52 = reps.
+PROPERTY_SLOTS = {"3": 0, "4": 1, "5": 2, "52": 3}
+
+def parse_properties(data: str) -> Tuple[int, float, int]:
+    '''Parse the "key-value,key-value" encoding of `entry.data` into (set, weight, reps).'''
+    values = [0.0, 0.0, 0.0, 0.0]
+    for pair in data.split(","):
+        key, _, value = pair.partition("-")
+        slot = PROPERTY_SLOTS.get(key)
+        if slot is None and "." in key:
+            slot = PROPERTY_SLOTS.get(f"{float(key):g}")
+        if slot is not None:
+            values[slot] = float(value)
+    return int(values[0]), values[1], int(values[2] + values[3])
+
+def parse_properties_batch(data: Iterable[str]) -> Tuple[array, array, array]:
+    '''Batched `parse_properties` returning (set, weight, reps) columns.'''
+    sets, weights, reps = array("l"), array("d"), array("l")
     for d in data:
-        time = datetime.fromtimestamp(d[0])
-        property_pairs = dict(map(lambda x: tuple(map(float, x.split("-"))), d[1].split(",")))
-        set_number = int(property_pairs.get(3, 0))
-        weight = property_pairs.get(4, 0)
-        reps = int(property_pairs.get(5, 0) + property_pairs.get(52, 0))
-        name = d[2]
-        unit = None if d[3] is None else "lbs" if d[3] == "2" else "kg"
-        if unit == "lbs":
-            weight = round(kg_to_lbs(weight))
-        else:
-            weight = int(weight)
-        result.append(Exercise(time, name, unit, weight, reps, set_number))
-
-    # Group result by name then sort by set
-    result.sort(key=lambda x: x.set)
-    result.sort(key=lambda x: x.name)
-    groups = []
-    for k, g in itertools.groupby(result, lambda x: x.name):
-        groups.append(list(g))
-        
-    return groups
+        set_number, weight, rep = parse_properties(d)
+        sets.append(set_number)
+        weights.append(weight)
+        reps.append(rep)
+    return sets, weights, reps
+
+def parse_unit(unit: str | None) -> Literal["lbs", "kg", None]:
+    return None if unit is None else "lbs" if unit == "2" else "kg"
+
+def display_weight(weight: float, unit: Literal["lbs", "kg", None]) -> int:
+    '''`Exercise.weight` from the kilograms GymRun stores.'''
+    return round(kg_to_lbs(weight)) if unit == "lbs" else int(weight)
+
+# Index of each unit in `ExerciseColumns.unit`.
+UNITS = (None, "kg", "lbs")
+
+class ExerciseColumns:
+    '''Array-backed columns of parsed sets.
+
+    Exercise names are interned in `names` and referenced by index from the
+    `exercise` column; `unit` holds indices into `UNITS`. Weights are
+    normalized the same way as `Exercise.weight`.
+    '''
+
+    def __init__(self):
+        self.time = array("q")
+        self.exercise = array("l")
+        self.unit = array("b")
+        self.weight = array("l")
+        self.reps = array("l")
+        self.set = array("l")
+        self.names: List[str] = []
+        self._name_ids: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    @classmethod
+    def from_rows(cls, data: List[Tuple[int, str, str, str]]) -> "ExerciseColumns":
+        columns = cls()
+        sets, weights, reps = parse_properties_batch(d[1] for d in data)
+        columns.time.extend(d[0] for d in data)
+        columns.set = sets
+        columns.reps = reps
+        for d, weight in zip(data, weights):
+            unit = parse_unit(d[3])
+            columns.exercise.append(columns.name_id(d[2]))
+            columns.unit.append(UNITS.index(unit))
+            columns.weight.append(display_weight(weight, unit))
+        return columns
+
+    @classmethod
+    def from_sets(cls, data: Iterable[Tuple[int, str, str, int, float, int]]) -> "ExerciseColumns":
+        '''Columns from already parsed (time, name, unit, set, weight in kg, reps) rows, as in history.db.'''
+        columns = cls()
+        for time, name, unit, set_number, weight, reps in data:
+            unit = parse_unit(unit)
+            columns.time.append(time)
+            columns.exercise.append(columns.name_id(name))
+            columns.unit.append(UNITS.index(unit))
+            columns.weight.append(display_weight(weight, unit))
+            columns.reps.append(reps)
+            columns.set.append(set_number)
+        return columns
+
+    def name_id(self, name: str) -> int:
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def max_time(self) -> int:
+        return max(self.time)
+
+    def group_indices(self) -> List[array]:
+        '''Row indices grouped by exercise name, ordered by name then set.'''
+        names, exercise, sets = self.names, self.exercise, self.set
+        order = sorted(range(len(self)), key=lambda i: (names[exercise[i]], sets[i]))
+        groups = []
+        for i in order:
+            if groups and exercise[groups[-1][0]] == exercise[i]:
+                groups[-1].append(i)
+            else:
+                groups.append(array("l", [i]))
+        return groups
+
+    def row(self, i: int) -> Exercise:
+        return Exercise(datetime.fromtimestamp(self.time[i]), self.names[self.exercise[i]],
+                        UNITS[self.unit[i]], self.weight[i], self.reps[i], self.set[i])
+
+    def to_groups(self) -> List[List[Exercise]]:
+        return [[self.row(i) for i in group] for group in self.group_indices()]
+
+@metrics.timed("parse")
+def parse_data(data: List[Tuple[int, str, str, str]]) -> List[List[Exercise]]:
+    return ExerciseColumns.from_rows(data).to_groups()
 
 def process_zip(data: bytes) -> List[List[Exercise]]:
     sqlite_file = get_sqlite_file(data)
@@ -0,0 +1,125 @@
+import os
+import sqlite3
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+from gymrun import Exercise, ExerciseColumns, parse_properties
+
+HISTORY_PATH = "history.db"
+
+# `weight` is kept as GymRun stores it (kilograms), units are resolved on read
+# the same way `parse_data` does.
+SCHEMA = """
+create table if not exists exercise (
+    _id integer primary key,
+    name text not null,
+    unit text
+);
+create table if not exists workout (
+    _id integer primary key,
+    time_start integer not null,
+    time_end integer not null
+);
+create table if not exists entry (
+    _id integer primary key,
+    time integer not null,
+    exercise integer not null,
+    workout integer,
+    set_number integer not null,
+    weight real not null,
+    reps integer not null
+);
+create index if not exists entry_exercise_time on entry (exercise, time);
+create index if not exists entry_workout on entry (workout);
+create table if not exists meta (
+    key text primary key,
+    value
+);
+"""
+
+NEW_ENTRIES_QUERY = """
+select e._id, e.time, e.exercise, w._id, e.data
+from backup.entry e
+left join backup.workout w
+    on w._id = (select _id from backup.workout where time_start <= e.time order by time_start desc limit 1)
+    and e.time <= w.time_end
+where (e.time, e._id) > (?, ?)
+order by e.time, e._id
+"""
+
+def connect(path: str = HISTORY_PATH) -> sqlite3.Connection:
+    '''Connection for writers, creating the database and its tables as needed.'''
+    conn = sqlite3.connect(path, timeout=30)
+    # WAL lets the read-only connections below read while a backup is merged.
+    # The mode is persistent, so it is only switched once per database.
+    if conn.execute("pragma journal_mode").fetchone()[0] != "wal":
+        conn.execute("pragma journal_mode=wal")
+    conn.executescript(SCHEMA)
+    return conn
+
+def connect_readonly(path: str = HISTORY_PATH) -> sqlite3.Connection:
+    '''Connection for readers, which runs no DDL and never creates the database.
+
+    Raises FileNotFoundError if there is no history at `path` yet.
+    '''
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    return sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True, timeout=30)
+
+def get_meta(conn: sqlite3.Connection, key: str, default=None):
+    row = conn.execute("select value from meta where key = ?", (key,)).fetchone()
+    return default if row is None else row[0]
+
+def set_meta(conn: sqlite3.Connection, key: str, value):
+    conn.execute("insert or replace into meta (key, value) values (?, ?)", (key, value))
+
+def high_water_mark(conn: sqlite3.Connection) -> Tuple[int, int]:
+    '''(time, _id) of the newest entry already merged into the store.'''
+    return get_meta(conn, "hwm_time", -1), get_meta(conn, "hwm_id", -1)
+
+def update_history(sqlite_file: bytes, path: str = HISTORY_PATH) -> int:
+    '''Merge entries newer than the high-water mark of `path` from a decrypted backup.
+
+    Returns the number of entries inserted.
+    '''
+    conn = connect(path)
+    try:
+        conn.execute("attach ':memory:' as backup")
+        conn.deserialize(sqlite_file, name="backup")
+        conn.execute("create index if not exists backup.workout_time_start on workout (time_start)")
+        with conn:
+            hwm_time, hwm_id = high_water_mark(conn)
+            conn.execute("insert or replace into exercise (_id, name, unit) select _id, xlabel, unit from backup.exercise")
+            conn.execute("insert or replace into workout (_id, time_start, time_end) select _id, time_start, time_end from backup.workout where time_end >= ?", (hwm_time,))
+
+            rows = []
+            for entry_id, time, exercise, workout, data in conn.execute(NEW_ENTRIES_QUERY, (hwm_time, hwm_id)):
+                set_number, weight, reps = parse_properties(data)
+                rows.append((entry_id, time, exercise, workout, set_number, weight, reps))
+            conn.executemany("insert or replace into entry (_id, time, exercise, workout, set_number, weight, reps) values (?, ?, ?, ?, ?, ?, ?)", rows)
+
+            if rows:
+                set_meta(conn, "hwm_time", rows[-1][1])
+                set_meta(conn, "hwm_id", rows[-1][0])
+        return len(rows)
+    finally:
+        conn.close()
+
+def find_workout(conn: sqlite3.Connection, workout: Optional[int] = None, date: Optional[str] = None) -> Optional[int]:
+    '''Id of `workout` if known, else of the last workout started on `date` (YYYY-MM-DD, local time).'''
+    if workout is not None:
+        row = conn.execute("select _id from workout where _id = ?", (workout,)).fetchone()
+    else:
+        row = conn.execute("select _id from workout where date(time_start, 'unixepoch', 'localtime') = ? "
+                           "order by time_start desc limit 1", (date,)).fetchone()
+    return None if row is None else row[0]
+
+def workout_version(conn: sqlite3.Connection, workout: int) -> Tuple[int, int]:
+    '''(number of sets, last set time) of a workout, which changes when sets are added to it.'''
+    return conn.execute("select count(*), coalesce(max(time), 0) from entry where workout = ?", (workout,)).fetchone()
+
+def workout_sets(conn: sqlite3.Connection, workout: int) -> List[List[Exercise]]:
+    '''Sets of one workout, grouped like `parse_data` groups the latest workout.'''
+    rows = conn.execute("select e.time, x.name, x.unit, e.set_number, e.weight, e.reps from entry e "
+                        "join exercise x on x._id = e.exercise where e.workout = ? order by e.time, e._id", (workout,))
+    return ExerciseColumns.from_sets(rows).to_groups()
@@ -0,0 +1,274 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from contextlib import closing
+from typing import Callable, Dict, List, Optional, Set
+
+import metrics
+
+JOBS_PATH = "jobs.db"
+# Notifications for the same key arriving within this window share one job.
+DEBOUNCE = 5.0
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 2.0
+MAX_RETRY_DELAY = 300.0
+# How often idle workers look for jobs enqueued by other processes.
+POLL_INTERVAL = 2.0
+# Profile every job, not only those enqueued with {"profile": true}.
+PROFILE_JOBS = os.environ.get("PROFILE_JOBS") == "1"
+# Worker threads per process, and how many of them one tenant may occupy.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+TENANT_CONCURRENCY = int(os.environ.get("TENANT_CONCURRENCY", "1"))
+# A running job is claimed for this long; the process running it renews the
+# lease every `LEASE / 4` seconds, so only jobs of a dead process expire.
+LEASE = float(os.environ.get("JOB_LEASE", "60"))
+
+logger = logging.getLogger('gunicorn.error')
+
+SCHEMA = """
+create table if not exists job (
+    id integer primary key,
+    key text not null,
+    status text not null,
+    tenant text not null default '',
+    payload text not null,
+    attempts integer not null default 0,
+    created real not null,
+    not_before real not null,
+    started real,
+    finished real,
+    error text,
+    lease_until real
+);
+create index if not exists job_status_not_before on job (status, not_before);
+create index if not exists job_key_status on job (key, status);
+"""
+
+# Added with tenants and leases; jobs.db files from before get the columns on open.
+TENANT_INDEX = "create index if not exists job_tenant_status on job (tenant, status, started)"
+
+# Due jobs whose key is idle and whose tenant has a free slot, tenants with
+# fewer running jobs first, then the tenant served least recently, so a
+# burst from one tenant queues behind the others instead of starving them.
+CLAIM_QUERY = """
+select id, key, payload, attempts from job j
+where status = 'pending' and not_before <= :now
+and not exists (select 1 from job r where r.key = j.key and r.status = 'running')
+and (select count(*) from job r where r.tenant = j.tenant and r.status = 'running') < :concurrency
+order by
+    (select count(*) from job r where r.tenant = j.tenant and r.status = 'running'),
+    coalesce((select max(started) from job r where r.tenant = j.tenant and r.status in ('running', 'done', 'failed')), 0),
+    not_before
+limit 1
+"""
+
+class JobQueue:
+    '''Persistent, debounced job queue with at most one running job per key.
+
+    Jobs are rows in a WAL-mode SQLite database, so they survive restarts and
+    are shared by every process using the same path. A job key looks like
+    `"process:alice"`; the handler is picked by the part before the colon and
+    the part after names the tenant, which `claim` schedules fairly.
+    Failed jobs are rescheduled with exponential backoff instead of sleeping,
+    so the worker keeps serving other keys meanwhile. A running job holds a
+    lease its process keeps renewing; if the process dies, the lease runs
+    out and the next worker to poll requeues the job.
+    '''
+
+    def __init__(self, path: str = JOBS_PATH, workers: int = JOB_WORKERS, tenant_concurrency: int = TENANT_CONCURRENCY):
+        self.path = path
+        self.workers = workers
+        self.tenant_concurrency = tenant_concurrency
+        self.handlers: Dict[str, Callable[[dict], object]] = {}
+        self.wakeup = threading.Condition()
+        self.threads: List[threading.Thread] = []
+        # Ids of the jobs this process is running, whose leases it renews.
+        self.running: Set[int] = set()
+        self.running_lock = threading.Lock()
+        with closing(self.connect()) as conn:
+            conn.executescript(SCHEMA)
+            if "tenant" not in {row[1] for row in conn.execute("pragma table_info(job)")}:
+                conn.execute("alter table job add column tenant text not null default ''")
+                conn.execute("update job set tenant = substr(key, instr(key, ':') + 1)")
+            if "lease_until" not in {row[1] for row in conn.execute("pragma table_info(job)")}:
+                conn.execute("alter table job add column lease_until real")
+            conn.execute(TENANT_INDEX)
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("pragma journal_mode=wal")
+        return conn
+
+    def handler(self, kind: str):
+        def register(fn):
+            self.handlers[kind] = fn
+            return fn
+        return register
+
+    def enqueue(self, key: str, payload: Optional[dict] = None, debounce: float = DEBOUNCE) -> int:
+        '''Add a job for `key`, or merge `payload` into the one already pending.'''
+        now = time.time()
+        conn = self.connect()
+        try:
+            conn.execute("begin immediate")
+            row = conn.execute("select id, payload from job where key = ? and status = 'pending'", (key,)).fetchone()
+            if row:
+                job_id, merged = row[0], {**json.loads(row[1]), **(payload or {})}
+                conn.execute("update job set payload = ?, not_before = max(not_before, ?) where id = ?",
+                             (json.dumps(merged), now + debounce, job_id))
+            else:
+                job_id = conn.execute("insert into job (key, tenant, status, payload, created, not_before) values (?, ?, 'pending', ?, ?, ?)",
+                                      (key, key.partition(":")[2], json.dumps(payload or {}), now, now + debounce)).lastrowid
+            conn.execute("commit")
+        finally:
+            conn.close()
+        self.notify()
+        return job_id
+
+    def notify(self):
+        with self.wakeup:
+            self.wakeup.notify_all()
+
+    def requeue_expired(self, conn: sqlite3.Connection, now: float):
+        '''Requeue running jobs whose lease ran out, as their process died mid-job.
+
+        This counts as a failed attempt, so a job that keeps killing its
+        worker ends up failed instead of being retried forever.
+        '''
+        # Jobs claimed before leases existed have none; they expire a lease after they started.
+        expired = "status = 'running' and coalesce(lease_until, started + :lease) < :now"
+        params = {"now": now, "lease": LEASE, "max_attempts": MAX_ATTEMPTS}
+        for job_id, key in conn.execute(f"select id, key from job where {expired}", params):
+            logger.error(f"job {job_id} {key} lease expired, requeueing")
+        conn.execute(f"update job set attempts = attempts + 1, lease_until = null, error = 'lease expired', "
+                     f"status = case when attempts + 1 >= :max_attempts then 'failed' else 'pending' end, "
+                     f"finished = case when attempts + 1 >= :max_attempts then :now end "
+                     f"where {expired}", params)
+
+    def claim(self, conn: sqlite3.Connection) -> Optional[tuple]:
+        conn.execute("begin immediate")
+        try:
+            now = time.time()
+            self.requeue_expired(conn, now)
+            row = conn.execute(CLAIM_QUERY, {"now": now, "concurrency": self.tenant_concurrency}).fetchone()
+            if row:
+                conn.execute("update job set status = 'running', started = ?, lease_until = ? where id = ?",
+                             (now, now + LEASE, row[0]))
+                with self.running_lock:
+                    self.running.add(row[0])
+            conn.execute("commit")
+            return row
+        except BaseException:
+            conn.execute("rollback")
+            raise
+
+    def run_one(self, conn: sqlite3.Connection) -> bool:
+        row = self.claim(conn)
+        if row is None:
+            return False
+        job_id, key, payload, attempts = row
+        kind = key.split(":", 1)[0]
+        payload = json.loads(payload)
+        try:
+            with metrics.timer(f"job_{kind}"):
+                if PROFILE_JOBS or payload.get("profile"):
+                    with metrics.sampling_profile(f"job-{job_id}-{kind}"):
+                        self.handlers[kind](payload)
+                else:
+                    self.handlers[kind](payload)
+        except Exception:
+            self.release(job_id)
+            attempts += 1
+            error = traceback.format_exc()
+            logger.error(f"job {job_id} {key} failed (attempt {attempts}): {error}")
+            if attempts >= MAX_ATTEMPTS:
+                conn.execute("update job set status = 'failed', attempts = ?, finished = ?, error = ? where id = ?",
+                             (attempts, time.time(), error, job_id))
+            else:
+                delay = min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (attempts - 1))
+                conn.execute("update job set status = 'pending', attempts = ?, not_before = ?, error = ? where id = ?",
+                             (attempts, time.time() + delay, error, job_id))
+        else:
+            self.release(job_id)
+            conn.execute("update job set status = 'done', attempts = ?, finished = ? where id = ?",
+                         (attempts + 1, time.time(), job_id))
+        # A finished job may unblock its key or tenant for another worker.
+        self.notify()
+        return True
+
+    def release(self, job_id: int):
+        with self.running_lock:
+            self.running.discard(job_id)
+
+    def heartbeat(self):
+        '''Renew the leases of the jobs this process is running.'''
+        conn = self.connect()
+        while True:
+            time.sleep(LEASE / 4)
+            with self.running_lock:
+                running = list(self.running)
+            if not running:
+                continue
+            try:
+                conn.execute(f"update job set lease_until = ? where status = 'running' and id in ({', '.join('?' * len(running))})",
+                             (time.time() + LEASE, *running))
+            except Exception as e:
+                logger.error(f"job heartbeat {e}")
+
+    def next_wakeup(self, conn: sqlite3.Connection) -> float:
+        row = conn.execute("select min(not_before) from job where status = 'pending'").fetchone()
+        if row[0] is None:
+            return POLL_INTERVAL
+        return min(POLL_INTERVAL, max(0.0, row[0] - time.time()))
+
+    def work(self):
+        conn = self.connect()
+        while True:
+            try:
+                while self.run_one(conn):
+                    pass
+                timeout = self.next_wakeup(conn)
+                with self.wakeup:
+                    self.wakeup.wait(timeout)
+            except Exception as e:
+                logger.error(f"job worker {e}")
+                time.sleep(POLL_INTERVAL)
+
+    def start(self):
+        if not self.threads:
+            self.prune()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            thread = threading.Thread(target=self.heartbeat, name="job-heartbeat", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stats(self) -> dict:
+        '''Queue depth per status and latency (created to finished) of recent jobs.'''
+        with closing(self.connect()) as conn:
+            depth = dict(conn.execute("select status, count(*) from job group by status").fetchall())
+            tenants = {tenant: dict(zip(("pending", "running"), counts)) for tenant, *counts in conn.execute(
+                "select tenant, sum(status = 'pending'), sum(status = 'running') from job "
+                "where status in ('pending', 'running') group by tenant")}
+            latencies = [r[0] for r in conn.execute(
+                "select finished - created from job where status = 'done' order by finished desc limit 100")]
+        latencies.sort()
+        return {
+            "depth": depth,
+            "tenants": tenants,
+            "latency": {
+                "count": len(latencies),
+                "p50": latencies[len(latencies) // 2] if latencies else None,
+                "max": latencies[-1] if latencies else None,
+            },
+        }
+
+    def prune(self, keep_seconds: float = 30 * 24 * 3600):
+        with closing(self.connect()) as conn:
+            conn.execute("delete from job where status in ('done', 'failed') and finished < ?", (time.time() - keep_seconds,))
@@ -0,0 +1,181 @@
+'''Minimal in-process metrics, exposed in Prometheus text format at /metrics.
+
+Each process keeps its own numbers; with several gunicorn workers a scrape
+sees the worker that answered it.
+'''
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PROFILE_DIR = "profiles"
+PROFILE_INTERVAL = 0.005
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_lock = threading.Lock()
+_counters: Dict[str, Dict[Labels, float]] = {}
+# name -> labels -> [bucket counts..., sum, count]
+_histograms: Dict[str, Dict[Labels, list]] = {}
+_help: Dict[str, str] = {}
+_collectors = []
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def describe(name: str, text: str):
+    _help[name] = text
+
+def inc(name: str, value: float = 1, **labels):
+    key = _labels(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+def observe(name: str, value: float, **labels):
+    key = _labels(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        state = series.get(key)
+        if state is None:
+            state = series[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                state[i] += 1
+        state[-2] += value
+        state[-1] += 1
+
+@contextmanager
+def timer(stage: str, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        inc("gymrun_stage_errors_total", stage=stage, **labels)
+        raise
+    finally:
+        observe("gymrun_stage_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+def timed(stage: str):
+    '''Decorator recording the duration of each call as a pipeline stage.'''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count_bytes(stage: str, direction: str, data) -> int:
+    size = len(data) if data is not None else 0
+    inc("gymrun_stage_bytes_total", size, stage=stage, direction=direction)
+    return size
+
+def register_collector(fn: Callable[[], Iterable[Tuple[str, dict, float]]]):
+    '''Add a callback yielding (gauge name, labels, value) at scrape time.'''
+    _collectors.append(fn)
+
+def drain() -> tuple:
+    '''Take and reset the counters and histograms recorded so far, for `merge`
+    into another process; CPU workers (see eventloop) send theirs back this way.'''
+    global _counters, _histograms
+    with _lock:
+        drained = _counters, _histograms
+        _counters, _histograms = {}, {}
+    return drained
+
+def merge(drained: Optional[tuple]):
+    if drained is None:
+        return
+    counters, histograms = drained
+    with _lock:
+        for name, series in counters.items():
+            target = _counters.setdefault(name, {})
+            for key, value in series.items():
+                target[key] = target.get(key, 0) + value
+        for name, series in histograms.items():
+            target = _histograms.setdefault(name, {})
+            for key, state in series.items():
+                current = target.get(key)
+                target[key] = list(state) if current is None else [a + b for a, b in zip(current, state)]
+
+def _format(name: str, labels: Labels, value) -> str:
+    if labels:
+        inner = ",".join(f'{k}="{v}"' for k, v in labels)
+        return f"{name}{{{inner}}} {value}"
+    return f"{name} {value}"
+
+def render() -> str:
+    lines = []
+    with _lock:
+        counters = {name: dict(series) for name, series in _counters.items()}
+        histograms = {name: {k: list(v) for k, v in series.items()} for name, series in _histograms.items()}
+    for name, series in sorted(counters.items()):
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} counter")
+        lines.extend(_format(name, labels, value) for labels, value in series.items())
+    for name, series in sorted(histograms.items()):
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, state in series.items():
+            for bound, count in zip(BUCKETS, state):
+                lines.append(_format(f"{name}_bucket", labels + (("le", f"{bound:g}"),), count))
+            lines.append(_format(f"{name}_bucket", labels + (("le", "+Inf"),), state[-1]))
+            lines.append(_format(f"{name}_sum", labels, state[-2]))
+            lines.append(_format(f"{name}_count", labels, state[-1]))
+    gauges: Dict[str, list] = {}
+    for collector in _collectors:
+        for name, labels, value in collector():
+            gauges.setdefault(name, []).append((_labels(labels), value))
+    for name, series in sorted(gauges.items()):
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(_format(name, labels, value) for labels, value in series)
+    return "\n".join(lines) + "\n"
+
+describe("gymrun_stage_seconds", "Duration of pipeline stages.")
+describe("gymrun_stage_errors_total", "Pipeline stage calls that raised.")
+describe("gymrun_stage_bytes_total", "Bytes consumed (in) and produced (out) by pipeline stages.")
+describe("gymrun_request_seconds", "HTTP request latency by endpoint.")
+describe("gymrun_card_cache_total", "Card endpoint cache outcomes.")
+describe("gymrun_fingerprint_total", "Backup fingerprint stages that skipped the pipeline, let it continue, or were unavailable.")
+
+@contextmanager
+def sampling_profile(name: str, interval: float = PROFILE_INTERVAL):
+    '''Sample the calling thread's stack every `interval` seconds.
+
+    Writes collapsed stacks (one "frame;frame;frame count" line per stack,
+    the input format of flamegraph.pl/speedscope) to profiles/<name>.txt.
+    '''
+    target = threading.get_ident()
+    samples = Counter()
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            frame = sys._current_frames().get(target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                samples[";".join(reversed(stack))] += 1
+
+    thread = threading.Thread(target=sample, name=f"profile-{name}", daemon=True)
+    thread.start()
+    try:
+        yield samples
+    finally:
+        done.set()
+        thread.join()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, f"{name}.txt"), "w") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
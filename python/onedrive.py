@@ -1,33 +1,41 @@
 import asyncio
 import os
+import threading
 import time
-from azure.core.credentials import AccessToken
-from msal import ConfidentialClientApplication, SerializableTokenCache
-from dotenv import load_dotenv
-from msgraph import GraphServiceClient
-from msgraph.generated.models.subscription import Subscription
-import aiohttp
+from typing import Dict, Optional, Tuple
 
-from gymrun import process_zip
+from config import require
+from credentials import ExpiringValue
+from httpclient import close_session, get_session
+import metrics
 
-load_dotenv()
+# MSAL, the Graph SDK and the Azure settings are only loaded once an account
+# is used: MSAL fetches the authority's metadata over the network when the
+# client is built, which would otherwise happen in every worker at boot.
 AZURE_TENANT_ID = "9188040d-6c67-4c5b-b112-36a304b66dad"
-AZURE_CLIENT_ID = os.environ["AZURE_CLIENT_ID"]
-AZURE_CLIENT_SECRET = os.environ["AZURE_CLIENT_SECRET"]
-AZURE_REDIRECT_URI = os.environ["AZURE_REDIRECT_URI"]
 scopes = ['https://graph.microsoft.com/.default']
+# Point at a stand-in server (see fake_graph.py) to run without Microsoft Graph.
+GRAPH_BASE_URL = os.environ.get("GRAPH_BASE_URL", "https://graph.microsoft.com")
+ZIP_PATH = "/Apps/GymRun/gymapp.zip"
+TOKEN_CACHE_PATH = "token_cache.bin"
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
 class MSALCredential:
-    def __init__(self):
+    def __init__(self, token_cache_path: str = TOKEN_CACHE_PATH):
+        from msal import ConfidentialClientApplication, SerializableTokenCache
+        self.token_cache_path = token_cache_path
         self.cache = SerializableTokenCache()
-        if os.path.exists("token_cache.bin"):
-            self.cache.deserialize(open("token_cache.bin", "r").read())
+        if os.path.exists(token_cache_path):
+            self.cache.deserialize(open(token_cache_path, "r").read())
         self.app = ConfidentialClientApplication(
-            client_id=AZURE_CLIENT_ID,
-            client_credential=AZURE_CLIENT_SECRET,
+            client_id=require("AZURE_CLIENT_ID", "OneDrive"),
+            client_credential=require("AZURE_CLIENT_SECRET", "OneDrive"),
             authority=f"https://login.microsoftonline.com/{AZURE_TENANT_ID}",
             token_cache=self.cache
         )
+        # Scopes -> in-memory token, refreshed ahead of expiry.
+        self.tokens = {}
+        self.tokens_lock = threading.Lock()
 
     def get_authorization_url(self, scopes):
         app = self.app
@@ -35,7 +43,7 @@ class MSALCredential:
         if "error" in result:
             raise Exception(f"{result}")
 
-        flow = app.initiate_auth_code_flow(scopes=scopes, redirect_uri=AZURE_REDIRECT_URI)
+        flow = app.initiate_auth_code_flow(scopes=scopes, redirect_uri=require("AZURE_REDIRECT_URI", "OneDrive sign-in"))
 
         if "error" in flow:
             raise Exception(f"{flow}")
@@ -70,10 +78,18 @@ class MSALCredential:
         enable_cae: bool = False,
         **kwargs
     ):
+        key = tuple(sorted(scopes))
+        with self.tokens_lock:
+            token = self.tokens.get(key)
+            if token is None:
+                token = self.tokens[key] = ExpiringValue(lambda: self.acquire_token(list(key)))
+        return token.get()
+
+    def acquire_token(self, scopes):
+        from azure.core.credentials import AccessToken
         result = None
         app = self.app
 
-        scopes = list(scopes)
         # print(f"{scopes = }")
 
         accounts = app.get_accounts()
@@ -87,41 +103,109 @@ class MSALCredential:
 
             auth_resp_url = input("Redirect URL: ")
             result = self.process_auth_response_url(auth_resp_url, flow)
-        
-        if result:
-            with open("token_cache.bin", "w") as f:
-                f.write(self.cache.serialize())
-
-        return AccessToken(result["access_token"], result["expires_in"] + time.time())
 
-credential = MSALCredential()
-client = GraphServiceClient(credentials=credential, scopes=scopes)
+        self.save_cache()
 
-async def get_zip():
-    item = await client.drives.with_url("https://graph.microsoft.com/v1.0/drives/me/root:/Apps/GymRun/gymapp.zip").get()
-    download_url = item.additional_data["@microsoft.graph.downloadUrl"]
-    async with aiohttp.ClientSession() as session:
-        async with session.get(download_url) as response:
-            if response.status == 200:
-                file_bytes = await response.read()
-                return file_bytes
-            else:
-                raise Exception("Failed to download file")
+        token = AccessToken(result["access_token"], int(result["expires_in"] + time.time()))
+        return token, token.expires_on
 
-async def register_subscription(url: str):
+    def save_cache(self):
+        # Only touch the disk when MSAL actually changed something.
+        if self.cache.has_state_changed:
+            with open(f"{self.token_cache_path}.tmp", "w") as f:
+                f.write(self.cache.serialize())
+            os.replace(f"{self.token_cache_path}.tmp", self.token_cache_path)
+
+# Token cache path -> credential, one signed-in OneDrive account each.
+_credentials: Dict[str, MSALCredential] = {}
+_credentials_lock = threading.Lock()
+
+def get_credential(token_cache_path: str = TOKEN_CACHE_PATH) -> MSALCredential:
+    with _credentials_lock:
+        cred = _credentials.get(token_cache_path)
+        if cred is None:
+            cred = _credentials[token_cache_path] = MSALCredential(token_cache_path)
+        return cred
+
+download_stats = {"checks": 0, "downloads": 0, "skipped": 0, "bytes_downloaded": 0, "bytes_avoided": 0}
+
+async def get_item(cred: Optional[MSALCredential] = None, zip_path: str = ZIP_PATH) -> Dict:
+    token = await asyncio.to_thread((cred or get_credential()).get_token, *scopes)
+    async with get_session().get(f"{GRAPH_BASE_URL}/v1.0/drives/me/root:{zip_path}",
+                                 headers={"Authorization": f"Bearer {token.token}"}) as response:
+        if response.status != 200:
+            raise Exception(f"Failed to get drive item: {response.status}")
+        return await response.json()
+
+def item_version(item: Dict) -> Dict:
+    return {key: item.get(key) for key in ("eTag", "cTag", "size", "lastModifiedDateTime")}
+
+async def download(url: str, size: Optional[int] = None) -> bytearray:
+    # Fill one buffer of the advertised size instead of joining chunks;
+    # slice assignment still grows it if the body turns out longer.
+    data = bytearray(size or 0)
+    offset = 0
+    async with get_session().get(url) as response:
+        if response.status != 200:
+            raise Exception("Failed to download file")
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            data[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+    del data[offset:]
+    return data
+
+async def get_zip_if_changed(last_version: Optional[Dict] = None, cred: Optional[MSALCredential] = None,
+                             zip_path: str = ZIP_PATH) -> Tuple[Optional[bytearray], Dict]:
+    '''Download the backup unless its eTag/cTag/size/lastModified match `last_version`.
+
+    Returns (zip bytes or None when unchanged, current version).
+    '''
+    with metrics.timer("check"):
+        item = await get_item(cred, zip_path)
+    version = item_version(item)
+    download_stats["checks"] += 1
+    if last_version == version:
+        download_stats["skipped"] += 1
+        download_stats["bytes_avoided"] += version["size"] or 0
+        return None, version
+    with metrics.timer("download"):
+        data = await download(item["@microsoft.graph.downloadUrl"], version["size"])
+    metrics.count_bytes("download", "in", data)
+    download_stats["downloads"] += 1
+    download_stats["bytes_downloaded"] += len(data)
+    return data, version
+
+async def get_zip() -> bytearray:
+    data, _ = await get_zip_if_changed()
+    return data
+
+async def register_subscription(url: str, cred: Optional[MSALCredential] = None, zip_path: str = ZIP_PATH,
+                                client_state: Optional[str] = None):
+    from msgraph import GraphServiceClient
+    from msgraph.generated.models.subscription import Subscription
     after_60_days_iso_8901 = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 60*24*60*60))
-    result = await client.drives.with_url("https://graph.microsoft.com/v1.0/drive/root/subscriptions").post(Subscription(
+    graph = GraphServiceClient(credentials=cred or get_credential(), scopes=scopes)
+    result = await graph.drives.with_url(f"{GRAPH_BASE_URL}/v1.0/drive/root/subscriptions").post(Subscription(
         change_type="updated",
         notification_url=url,
-        resource="/drives/me/root:/Apps/GymRun/gymapp.zip",
+        resource=f"/drives/me/root:{zip_path}",
         expiration_date_time=after_60_days_iso_8901,
+        client_state=client_state,
     ))
     return result
 
-async def main():
-    zip = await get_zip()
+async def main(cred: Optional[MSALCredential] = None, zip_path: str = ZIP_PATH):
+    from gymrun import process_zip
+    zip, _ = await get_zip_if_changed(cred=cred, zip_path=zip_path)
     print("process_zip", process_zip(zip))
+    print("download_stats", download_stats)
+    await close_session()
 
 if __name__ == "__main__":
-    asyncio.run(main())
-    pass
+    # `python onedrive.py <tenant>` signs that tenant's OneDrive account in.
+    import sys
+    from tenants import get_tenant
+    tenant = get_tenant(sys.argv[1]) if len(sys.argv) > 1 else get_tenant()
+    if tenant is None:
+        sys.exit(f"no such tenant: {sys.argv[1]}")
+    asyncio.run(main(get_credential(tenant.path(TOKEN_CACHE_PATH)), tenant.zip_path or ZIP_PATH))
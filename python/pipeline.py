@@ -0,0 +1,48 @@
+'''The CPU-bound steps of processing a backup.
+
+They run in the CPU worker processes (see eventloop.run_cpu), which import
+this module instead of the app, so arguments and results cross a process
+boundary and must pickle.
+'''
+import analytics
+from artifacts import artifacts_lock, build_artifacts
+from gymrun import get_sqlite_file, max_entry_time, process_db, read_sqlite_header, sqlite_change_counter, zip_entry_fingerprint
+from history import HISTORY_PATH, update_history
+import metrics
+from render import DATA_PATH, store_data
+
+def unchanged(stage, value, fingerprint, previous):
+    '''Record one fingerprint stage; True when `value` shows the backup holds nothing new.'''
+    fingerprint[stage] = value
+    if value is None:
+        result = "unavailable"
+    else:
+        result = "skip" if value == previous.get(stage) else "continue"
+    metrics.inc("gymrun_fingerprint_total", stage=stage, result=result)
+    return result == "skip"
+
+def ingest(tenant, zip, previous):
+    '''Decrypt a backup into the tenant's history and return its most recent
+    workout, with the backup's fingerprint.
+
+    Stages of increasing cost compare the fingerprint with `previous`, that
+    of the last processed backup, and return no workout at the first match:
+    the zip entry's CRC, the database header's change counter (only the
+    first block is decrypted), then the newest entry time.
+    '''
+    fingerprint = {}
+    if unchanged("zip", zip_entry_fingerprint(zip), fingerprint, previous):
+        return None, fingerprint
+    if unchanged("header", sqlite_change_counter(read_sqlite_header(zip)), fingerprint, previous):
+        return None, fingerprint
+    sqlite_file = get_sqlite_file(zip)
+    if unchanged("max_time", max_entry_time(sqlite_file), fingerprint, previous):
+        return None, fingerprint
+    update_history(sqlite_file, tenant.path(HISTORY_PATH))
+    analytics.update_aggregates(tenant.path(HISTORY_PATH))
+    return process_db(sqlite_file), fingerprint
+
+def publish_data(tenant, data):
+    with artifacts_lock(tenant.root):
+        store_data(data, tenant.path(DATA_PATH))
+        return build_artifacts(data, root=tenant.root)
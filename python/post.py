@@ -1,22 +1,26 @@
+import io
+import logging
 import os
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import cache
+from typing import Dict, List, Optional, Sequence
+
 from dotenv import load_dotenv
-from mastodon import Mastodon
-from retry import retry
-from misskey import Misskey
 
+from config import require
 from gymrun import Exercise
+import metrics
+import state
 
 load_dotenv()
 
-MASTODON_BASE_URL = os.environ['MASTODON_BASE_URL']
-MASTODON_CLIENT_KEY = os.environ['MASTODON_CLIENT_KEY']
-MASTODON_CLIENT_SECRET = os.environ['MASTODON_CLIENT_SECRET']
-MASTODON_ACCESS_TOKEN = os.environ['MASTODON_ACCESS_TOKEN']
-MISSKEY_BASE_URL = os.environ['MISSKEY_BASE_URL']
-MISSKEY_ACCESS_TOKEN = os.environ['MISSKEY_ACCESS_TOKEN']
-POST_MODE = os.environ['POST_MODE']
+# Comma-separated target names. The part before the first underscore picks
+# the service, the whole name the env prefix: "mastodon_work" reads
+# MASTODON_WORK_BASE_URL etc. Falls back to the single-target POST_MODE.
+POST_TARGETS = [t.strip() for t in os.environ.get("POST_TARGETS", os.environ.get("POST_MODE", "")).split(",") if t.strip()]
 
+logger = logging.getLogger('gunicorn.error')
 
 def caption(exercises: List[List[Exercise]]) -> str:
     groups = []
@@ -25,20 +29,94 @@ def caption(exercises: List[List[Exercise]]) -> str:
         groups.append(f"{exercise[0].name}\n{sets}")
     return "Recent workout\n\n" + "\n\n".join(groups)
 
-@retry(delay=1, backoff=2, max_delay=4, tries=5)
-def toot_card(exercises: List[List[Exercise]], time):
-    text = caption(exercises)
-    if POST_MODE == "mastodon":
-        mastodon = Mastodon(client_id=MASTODON_CLIENT_KEY, client_secret=MASTODON_CLIENT_SECRET,
-                            access_token=MASTODON_ACCESS_TOKEN, api_base_url=MASTODON_BASE_URL)
-        media = mastodon.media_post("card.png", mime_type="image/png", description=text)
-        post = mastodon.status_post("Workout of the day.", visibility="public", language="en", media_ids=[media["id"]])
+# Client libraries are imported and settings read when a target is first
+# used, so neither is needed by workers that never post.
+class MastodonTarget:
+    def __init__(self, name: str):
+        from mastodon import Mastodon
+        prefix = name.upper()
+        self.base_url = require(f'{prefix}_BASE_URL', name)
+        self.client = Mastodon(client_id=require(f'{prefix}_CLIENT_KEY', name), client_secret=require(f'{prefix}_CLIENT_SECRET', name),
+                               access_token=require(f'{prefix}_ACCESS_TOKEN', name), api_base_url=self.base_url)
+
+    def post(self, png: bytes, text: str, time: datetime) -> str:
+        media = self.client.media_post(io.BytesIO(png), mime_type="image/png", description=text,
+                                       file_name=f"gymrun-{time.isoformat()}.png")
+        post = self.client.status_post("Workout of the day.", visibility="public", language="en", media_ids=[media["id"]])
         return post["url"]
-    elif POST_MODE == "misskey":
-        with open("card.png", "rb") as f:    
-            mk = Misskey(address=MISSKEY_BASE_URL, i=MISSKEY_ACCESS_TOKEN)
-            file = mk.drive_files_create(file=f, name=f"gymrun-{time.isoformat()}.png")
-            mk.drive_files_update(file["id"], comment=text)
-            post = mk.notes_create(text="Workout of the day.", visibility="public", file_ids=[file["id"]])
-            return f"{MISSKEY_BASE_URL}/notes/{post['createdNote']['id']}"
 
+class MisskeyTarget:
+    def __init__(self, name: str):
+        from misskey import Misskey
+        prefix = name.upper()
+        self.base_url = require(f'{prefix}_BASE_URL', name)
+        self.client = Misskey(address=self.base_url, i=require(f'{prefix}_ACCESS_TOKEN', name))
+
+    def post(self, png: bytes, text: str, time: datetime) -> str:
+        file = self.client.drive_files_create(file=io.BytesIO(png), name=f"gymrun-{time.isoformat()}.png")
+        self.client.drive_files_update(file["id"], comment=text)
+        post = self.client.notes_create(text="Workout of the day.", visibility="public", file_ids=[file["id"]])
+        return f"{self.base_url}/notes/{post['createdNote']['id']}"
+
+TARGET_TYPES = {
+    "mastodon": MastodonTarget,
+    "misskey": MisskeyTarget,
+}
+
+@cache
+def get_target(name: str):
+    return TARGET_TYPES[name.split("_", 1)[0]](name)
+
+@cache
+def get_executor() -> ThreadPoolExecutor:
+    # Shared by all tenants, so not sized by the default targets alone.
+    return ThreadPoolExecutor(max(4, len(POST_TARGETS)), thread_name_prefix="publish")
+
+def idempotency_key(target: str, time: datetime) -> str:
+    return f"posted:{target}:{time.isoformat()}"
+
+def publish_to(target: str, png: bytes, text: str, time: datetime, store: Optional[state.StateStore] = None) -> str:
+    '''Post to one target, at most once per workout.
+
+    Makes a single attempt: a failure fails the post job, which the job
+    queue reschedules with backoff instead of holding a worker thread.
+    '''
+    store = store or state.get_store()
+    key = idempotency_key(target, time)
+    url = store.get(key)
+    if url:
+        return url
+    try:
+        with metrics.timer("publish_target", target=target):
+            url = get_target(target).post(png, text, time)
+    except Exception as e:
+        logger.warning(f"publish to {target} failed: {e}")
+        raise
+    store.set(key, url)
+    return url
+
+@metrics.timed("publish")
+def publish(text: str, time: datetime, png: bytes, targets: Sequence[str] = POST_TARGETS,
+            store: Optional[state.StateStore] = None) -> Dict[str, str]:
+    '''Post the card to every target concurrently. Returns target -> post URL.
+
+    Targets that already succeeded for this workout are skipped, so the
+    job can be retried safely. Raises if any target failed.
+    '''
+    futures = {target: get_executor().submit(publish_to, target, png, text, time, store) for target in targets}
+    results, errors = {}, {}
+    for target, future in futures.items():
+        try:
+            results[target] = future.result()
+        except Exception as e:
+            errors[target] = e
+    if errors:
+        raise Exception(f"publish failed for {', '.join(errors)}: {errors}")
+    return results
+
+def toot_card(png_path: str, text: str, time: datetime, targets: Sequence[str] = POST_TARGETS,
+              store: Optional[state.StateStore] = None) -> Dict[str, str]:
+    '''Post the PNG at `png_path`, a content-hashed artifact, as the card of the workout at `time`.'''
+    with open(png_path, "rb") as f:
+        png = f.read()
+    return publish(text, time, png, targets, store)
@@ -0,0 +1,172 @@
+import base64
+import os
+import queue
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from tempfile import NamedTemporaryFile
+
+import metrics
+
+FONT_PATH = "./static/Archivo[wdth,wght].ttf"
+RASTERIZER = os.environ.get("RASTERIZER", "inkscape")
+RASTER_WORKERS = int(os.environ.get("RASTER_WORKERS", "2"))
+RASTER_TIMEOUT = float(os.environ.get("RASTER_TIMEOUT", "30"))
+
+class RasterizeError(Exception):
+    pass
+
+class Rasterizer:
+    '''Turns a card SVG into PNG bytes.
+
+    `embed_font` tells `build_svg` whether the backend needs the font inlined
+    as a data URL or can load it from `FONT_PATH`.
+    '''
+    embed_font = False
+    # Backends whose work can outlive the caller's timeout release the slot
+    # themselves when it really finishes, so abandoned renders still count.
+    releases_slot = False
+
+    def __init__(self, workers: int = RASTER_WORKERS, scale: float = 1):
+        self.workers = workers
+        self.scale = scale
+        self.slots = threading.BoundedSemaphore(workers)
+
+    def rasterize(self, svg: str, timeout: float = RASTER_TIMEOUT) -> bytes:
+        if not self.slots.acquire(timeout=timeout):
+            raise RasterizeError(f"{type(self).__name__}: no free worker within {timeout}s")
+        try:
+            with metrics.timer("rasterize", backend=type(self).__name__):
+                png = self._rasterize(svg, timeout)
+            metrics.count_bytes("rasterize", "out", png)
+            return png
+        finally:
+            if not self.releases_slot:
+                self.slots.release()
+
+    def _rasterize(self, svg: str, timeout: float) -> bytes:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class InkscapeRasterizer(Rasterizer):
+    def _rasterize(self, svg: str, timeout: float) -> bytes:
+        # Write next to the font so the relative @font-face URL still resolves.
+        with NamedTemporaryFile("w", suffix=".svg", dir=".", delete=False) as f:
+            f.write(svg)
+        try:
+            result = subprocess.run(
+                ["inkscape", f.name, "--export-type=png", "--export-filename=-", f"--export-dpi={96 * self.scale:g}"],
+                capture_output=True, timeout=timeout,
+            )
+        except subprocess.TimeoutExpired as e:
+            raise RasterizeError(f"inkscape timed out after {timeout}s") from e
+        finally:
+            os.unlink(f.name)
+        if result.returncode != 0 or not result.stdout:
+            raise RasterizeError(f"inkscape failed: {result.stderr.decode(errors='replace')}")
+        return result.stdout
+
+class ResvgRasterizer(Rasterizer):
+    '''In-process rasterizer, no browser or subprocess needed.'''
+    releases_slot = True
+
+    def __init__(self, workers: int = RASTER_WORKERS, scale: float = 2):
+        super().__init__(workers, scale)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="resvg")
+
+    def _rasterize(self, svg: str, timeout: float) -> bytes:
+        try:
+            import resvg_py
+            future = self.executor.submit(
+                resvg_py.svg_to_bytes, svg_string=svg, skip_system_fonts=True,
+                font_files=[FONT_PATH], zoom=self.scale,
+            )
+        except BaseException:
+            self.slots.release()
+            raise
+        # A render that times out keeps running in the executor; its slot is
+        # only freed once it ends.
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return bytes(future.result(timeout=timeout))
+        except TimeoutError as e:
+            raise RasterizeError(f"resvg timed out after {timeout}s") from e
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class ChromeRasterizer(Rasterizer):
+    '''Pool of long-lived headless Chrome instances, started on demand.'''
+    embed_font = True
+    releases_slot = True
+
+    def __init__(self, workers: int = RASTER_WORKERS, scale: float = 2):
+        super().__init__(workers, scale)
+        self.idle = queue.LifoQueue()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="chrome")
+
+    def new_driver(self):
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+
+        options = Options()
+        options.add_argument('--no-sandbox')
+        options.add_argument('--headless')
+        options.add_argument(f"--force-device-scale-factor={self.scale:g}")
+        # No fixed --remote-debugging-port: each pooled browser gets its own.
+        return webdriver.Chrome(options=options)
+
+    def screenshot(self, driver, svg: str, timeout: float) -> bytes:
+        from selenium.webdriver.common.by import By
+
+        driver.set_page_load_timeout(timeout)
+        driver.get("data:image/svg+xml;base64," + base64.b64encode(svg.encode()).decode())
+        svg_element = driver.find_element(By.TAG_NAME, 'svg')
+        driver.set_window_size(svg_element.get_attribute('width'), svg_element.get_attribute('height'))
+        return driver.get_screenshot_as_png()
+
+    def _rasterize(self, svg: str, timeout: float) -> bytes:
+        try:
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                driver = self.new_driver()
+            # Any browser command can hang, not only the page load, so the
+            # timeout covers all of them.
+            future = self.executor.submit(self.screenshot, driver, svg, timeout)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            png = future.result(timeout=timeout)
+        except Exception as e:
+            # A browser in an unknown state is not returned to the pool.
+            # Quitting it also ends a hung command, and with it the slot.
+            driver.quit()
+            if isinstance(e, TimeoutError):
+                raise RasterizeError(f"chrome timed out after {timeout}s") from e
+            raise RasterizeError(f"chrome failed: {e}") from e
+        self.idle.put(driver)
+        return png
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        while True:
+            try:
+                self.idle.get_nowait().quit()
+            except queue.Empty:
+                break
+
+RASTERIZERS = {
+    "inkscape": InkscapeRasterizer,
+    "resvg": ResvgRasterizer,
+    "chrome": ChromeRasterizer,
+}
+
+@cache
+def get_rasterizer(name: str = RASTERIZER) -> Rasterizer:
+    return RASTERIZERS[name]()
@@ -1,28 +1,76 @@
 from datetime import datetime
-from typing import List, Literal
+from functools import cache, lru_cache
+from io import BytesIO
+from typing import Dict, List, Literal, Optional, Tuple
+import hashlib
+import os
 import pickle
-import pathlib
 import base64
+import re
 
 import humanize
 from jinja2 import Template
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
 
+from cardcache import CardCache, default_cache
 from gymrun import Exercise, lbs_to_kg, kg_to_lbs
-import subprocess
-
-chrome_options = Options()
-chrome_options.add_argument('--no-sandbox')
-chrome_options.add_argument('--headless')
-chrome_options.add_argument("--remote-debugging-port=9222")
-chrome_options.add_argument(f"--force-device-scale-factor=2")
+import history
+import metrics
+from raster import FONT_PATH, Rasterizer, get_rasterizer
+import snapshot
+from snapshot import Snapshot
 
 Unit = Literal["lbs", "kg", "native"]
 
-with open("./static/Archivo[wdth,wght].ttf", "rb") as f:
-    font_b64 = "data:application/font-ttf;charset=utf-8;base64," + base64.b64encode(f.read()).decode("utf-8")
+FONT_PLACEHOLDER = "__font_b64__"
+
+@cache
+def get_font() -> bytes:
+    with open(FONT_PATH, "rb") as f:
+        return f.read()
+
+# Weights the template draws text in, from the 350 of the sets to the 600
+# of the exercise names, and the narrowest width `calculate_stretch` asks of
+# the font; the embedded font keeps only these ranges of its axes.
+FONT_WEIGHTS = (350, 600)
+FONT_MIN_WIDTH = 62
+
+@cache
+def get_font_instance(narrow: bool) -> bytes:
+    '''The font limited to the template's weights, at normal width unless `narrow`.'''
+    from fontTools.ttLib import TTFont
+    from fontTools.varLib import instancer
+    font = instancer.instantiateVariableFont(TTFont(BytesIO(get_font())), {
+        "wght": FONT_WEIGHTS,
+        "wdth": (FONT_MIN_WIDTH, 100) if narrow else 100,
+    })
+    out = BytesIO()
+    font.save(out)
+    return out.getvalue()
+
+@lru_cache(maxsize=64)
+def subset_font_b64(text: str, narrow: bool = False) -> str:
+    '''WOFF2 data URL of the font reduced to the glyphs needed for `text`.
+
+    Cards with no exercise name narrowed (see `calculate_stretch`) get a
+    font without the width axis.
+    '''
+    # fontTools' subsetter is slow to import and only needed for embedded fonts.
+    from fontTools import subset
+    from fontTools.ttLib import TTFont
+    font = TTFont(BytesIO(get_font_instance(narrow)))
+    options = subset.Options()
+    options.flavor = "woff2"
+    options.hinting = False
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(text=text)
+    subsetter.subset(font)
+    out = BytesIO()
+    subset.save_font(font, out, options)
+    return "data:font/woff2;base64," + base64.b64encode(out.getvalue()).decode("utf-8")
+
+def card_text(svg: str) -> str:
+    # Sorted set of characters drawn by the card, so equal glyph sets share a cache entry.
+    return "".join(sorted(set("".join(re.findall(r"<tspan[^>]*>([^<]*)</tspan>", svg)))))
 
 def format_set(exercises: List[Exercise], unit: Unit) -> str:
     if unit == "native":
@@ -38,6 +86,7 @@ def format_set(exercises: List[Exercise], unit: Unit) -> str:
         for exercise in exercises:
             if exercise.unit is None:
                 sets.append(f"×{exercise.reps}")
+                continue
             elif exercise.unit == "kg":
                 weight = round(kg_to_lbs(exercise.weight))
             else:
@@ -49,6 +98,7 @@ def format_set(exercises: List[Exercise], unit: Unit) -> str:
         for exercise in exercises:
             if exercise.unit is None:
                 sets.append(f"×{exercise.reps}")
+                continue
             elif exercise.unit == "lbs":
                 weight = round(lbs_to_kg(exercise.weight))
             else:
@@ -56,21 +106,149 @@ def format_set(exercises: List[Exercise], unit: Unit) -> str:
             sets.append(f"{weight}kg×{exercise.reps}")
         return ", ".join(sets)
 
-def store_data(data: List[List[Exercise]]):
-    with open("data.pickle", "wb") as f:
-        pickle.dump(data, f)
+DATA_PATH = "data.snapshot"
+# Written by earlier versions; converted to a snapshot the first time it is read.
+LEGACY_DATA_PATH = "data.pickle"
+
+def store_data(data: List[List[Exercise]], path: str = DATA_PATH):
+    snapshot.write(path, data)
+
+def migrate_data(path: str = DATA_PATH, replace: bool = False) -> bool:
+    '''Convert the legacy pickle, if any, unless a snapshot exists and not `replace`.'''
+    legacy = os.path.join(os.path.dirname(path), LEGACY_DATA_PATH)
+    if (replace or not os.path.exists(path)) and os.path.exists(legacy):
+        with open(legacy, "rb") as f:
+            store_data(pickle.load(f), path)
+        return True
+    return False
+
+def open_data(path: str = DATA_PATH) -> Snapshot:
+    try:
+        return Snapshot(path)
+    except FileNotFoundError:
+        migrate_data(path)
+    except snapshot.SnapshotError:
+        # Unreadable, e.g. cut short by a crash: fall back to the legacy data if there is any.
+        if not migrate_data(path, replace=True):
+            raise
+    return Snapshot(path)
+
+def load_data(path: str = DATA_PATH) -> List[List[Exercise]]:
+    return open_data(path).to_groups()
+
+def data_version(path: str = DATA_PATH) -> Tuple[int, int, int]:
+    # Snapshots are replaced by rename, so a new one always has a new inode.
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        migrate_data(path)
+        st = os.stat(path)
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+# path -> (file version, snapshot generation, snapshot, last workout time),
+# reopened only when the file changes.
+_loaded_data: Dict[str, tuple] = {}
+# (path, snapshot generation, unit, humanized time) -> rendered SVG
+CARD_CACHE_SIZE = 16
+_card_cache: Dict[tuple, str] = {}
+
+def load_data_cached(path: str = DATA_PATH) -> Tuple[int, Snapshot, datetime]:
+    version = data_version(path)
+    loaded = _loaded_data.get(path)
+    if loaded is None or loaded[0] != version:
+        data = open_data(path)
+        loaded = _loaded_data[path] = (version, data.generation, data, data.last_time)
+        for key in [key for key in _card_cache if key[0] == path]:
+            _card_cache.pop(key, None)
+    return loaded[1:]
+
+def normalize_unit(unit: str) -> Unit:
+    # format_set renders anything other than native/lbs as kg.
+    return unit if unit in ("native", "lbs") else "kg"
+
+def card_key(unit: Unit, path: str = DATA_PATH) -> tuple:
+    version, _, last_time = load_data_cached(path)
+    return path, version, unit, humanize.naturaltime(datetime.now() - last_time)
+
+def card_etag(key: tuple) -> str:
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+def get_card_svg(key: tuple) -> str:
+    svg = _card_cache.get(key)
+    metrics.inc("gymrun_card_cache_total", endpoint="card.svg", result="miss" if svg is None else "hit")
+    if svg is None:
+        path, key_version, unit, _ = key
+        version, data, _ = load_data_cached(path)
+        svg = build_svg(data, unit)
+        if key_version == version:
+            if len(_card_cache) >= CARD_CACHE_SIZE:
+                _card_cache.clear()
+            _card_cache[key] = svg
+    return svg
+
+@cache
+def get_workout_cache() -> CardCache:
+    return default_cache()
+
+def workout_card_key(workout: Optional[int], date: Optional[str], unit: Unit, kind: Literal["svg", "png"],
+                     path: str = history.HISTORY_PATH) -> Optional[tuple]:
+    '''Cache key of the card of a past workout, by id or date, or None if
+    there is no such workout or no history yet.
 
-def load_data() -> List[List[Exercise]]:
-    with open("data.pickle", "rb") as f:
-        return pickle.load(f)
+    The key changes when sets are added to the workout or its humanized
+    time moves on, so it also serves as the ETag.
+    '''
+    try:
+        conn = history.connect_readonly(path)
+    except FileNotFoundError:
+        return None
+    try:
+        workout = history.find_workout(conn, workout, date)
+        if workout is None:
+            return None
+        sets, last_time = history.workout_version(conn, workout)
+    finally:
+        conn.close()
+    if not sets:
+        return None
+    return path, workout, sets, last_time, unit, humanize.naturaltime(datetime.now() - datetime.fromtimestamp(last_time)), kind
+
+def get_workout_card(key: tuple) -> bytes:
+    card_cache = get_workout_cache()
+    body = card_cache.get(key)
+    metrics.inc("gymrun_card_cache_total", endpoint=f"workout_{key[-1]}", result="miss" if body is None else "hit")
+    if body is None:
+        path, workout, _, _, unit, _, kind = key
+        conn = history.connect_readonly(path)
+        try:
+            data = history.workout_sets(conn, workout)
+        finally:
+            conn.close()
+        if kind == "svg":
+            body = build_svg(data, unit).encode()
+        else:
+            rasterizer = get_rasterizer()
+            body = rasterizer.rasterize(build_svg(data, unit, font_url=not rasterizer.embed_font))
+        card_cache.put(key, body)
+    return body
 
 def calculate_stretch(name: str) -> str:
     return f"{int(min(100, max(0, len(name) * -2.1 + 194)))}"  # Archivo
 
-def build_svg(data: List[List[Exercise]], unit: Unit = "native", font_url = False) -> str:
+@cache
+def get_template() -> Template:
     with open("template.svg") as f:
-        template = Template(f.read())
-    last_time = max(map(lambda x: x.time, sum(data, [])))
+        return Template(f.read())
+
+def get_last_time(data: List[List[Exercise]]) -> datetime:
+    if isinstance(data, Snapshot):
+        return data.last_time
+    return max(e.time for group in data for e in group)
+
+@metrics.timed("build_svg")
+def build_svg(data: List[List[Exercise]], unit: Unit = "native", font_url = False) -> str:
+    template = get_template()
+    last_time = get_last_time(data)
     last_time_word = humanize.naturaltime(datetime.now() - last_time)
 
     exercises = [{
@@ -79,42 +257,24 @@ def build_svg(data: List[List[Exercise]], unit: Unit = "native", font_url = Fals
         "stretch": calculate_stretch(e[0].name),
     } for e in data]
     
-    svg = template.render(exercises=exercises, last_update=last_time_word, font_b64="./static/Archivo[wdth,wght].ttf" if font_url else font_b64)
+    if font_url:
+        return template.render(exercises=exercises, last_update=last_time_word, font_b64=FONT_PATH)
+    svg = template.render(exercises=exercises, last_update=last_time_word, font_b64=FONT_PLACEHOLDER)
+    narrow = any(int(e["stretch"]) < 100 for e in exercises)
+    svg = svg.replace(FONT_PLACEHOLDER, subset_font_b64(card_text(svg), narrow), 1)
     
     return svg
 
-def render(data: List[List[Exercise]], unit: Unit = "native"):
+def render(data: List[List[Exercise]], unit: Unit = "native", rasterizer: Rasterizer | None = None):
+    rasterizer = rasterizer or get_rasterizer()
     store_data(data)
-    svg = build_svg(data, unit, font_url=True)
+    svg = build_svg(data, unit, font_url=not rasterizer.embed_font)
     with open("card.svg", "w") as f:
         f.write(svg)
 
-    # Run the inkscape command to convert SVG to PNG
-    subprocess.run(["inkscape", "card.svg", "--export-filename=card.png"])
+    png = rasterizer.rasterize(svg)
+    with open("card.png", "wb") as f:
+        f.write(png)
 
 def render_chrome(data: List[List[Exercise]], unit: Unit = "native"):
-    store_data(data)
-    svg = build_svg(data, unit)
-    with open("card.svg", "w") as f:
-        f.write(svg)
-
-    driver = webdriver.Chrome(options=chrome_options)
-
-    # Load the SVG image
-    driver.get(pathlib.Path("card.svg").absolute().as_uri())
-
-    # Get the SVG element
-    svg_element = driver.find_element(By.TAG_NAME, 'svg')
-
-    # Get the dimensions of the SVG element
-    width = svg_element.get_attribute('width')
-    height = svg_element.get_attribute('height')
-
-    # Set the dimensions of the browser window to match the SVG element
-    driver.set_window_size(width, height)
-
-    # Take a screenshot of the SVG element and save it as a PNG file
-    driver.save_screenshot('card.png')
-
-    # Quit the driver
-    driver.quit()
+    render(data, unit, get_rasterizer("chrome"))
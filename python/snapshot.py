@@ -0,0 +1,139 @@
+'''Compact, memory-mapped snapshot of the sets in the latest backup.
+
+Layout, little-endian:
+
+    header    magic, format version, generation, last set time,
+              number of groups, records and names
+    names     (names + 1) u32 offsets into the UTF-8 blob that follows
+    groups    (groups + 1) u32 record offsets, one group per exercise,
+              4-byte aligned
+    records   8-byte aligned, fixed-width (time, name, unit, weight, reps, set)
+
+Snapshots are written to a temporary file and renamed over the old one, so
+readers see either the old or the new file in full. Mapped read-only, the
+pages are shared by every worker through the page cache.
+'''
+import mmap
+import os
+import struct
+import threading
+import time
+from collections.abc import Sequence
+from datetime import datetime
+from typing import Dict, List
+
+from gymrun import UNITS, Exercise
+
+MAGIC = b"GYMSNAP\x00"
+FORMAT_VERSION = 1
+
+# magic, format version, generation, last set time, groups, records, names
+HEADER = struct.Struct("<8sIQqIII")
+OFFSET = struct.Struct("<I")
+# time, name index, index into `gymrun.UNITS`, weight, reps, set
+RECORD = struct.Struct("<qIB3xiii")
+
+class SnapshotError(Exception):
+    pass
+
+def _offsets(values: List[int]) -> bytes:
+    return struct.pack(f"<{len(values)}I", *values)
+
+def _pad(offset: int, alignment: int) -> bytes:
+    return b"\x00" * (-offset % alignment)
+
+def write(path: str, data: List[List[Exercise]]) -> int:
+    '''Write `data` to `path` atomically. Returns the new generation.'''
+    names: List[bytes] = []
+    name_ids: Dict[str, int] = {}
+    name_offsets = [0]
+    group_offsets = [0]
+    records = bytearray()
+    last_time = 0
+    for group in data:
+        for e in group:
+            name_id = name_ids.get(e.name)
+            if name_id is None:
+                name_id = name_ids[e.name] = len(names)
+                names.append(e.name.encode())
+                name_offsets.append(name_offsets[-1] + len(names[-1]))
+            timestamp = int(e.time.timestamp())
+            last_time = max(last_time, timestamp)
+            records += RECORD.pack(timestamp, name_id, UNITS.index(e.unit), e.weight, e.reps, e.set)
+        group_offsets.append(len(records) // RECORD.size)
+
+    generation = time.time_ns()
+    blob = b"".join(names)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, generation, last_time, len(data), len(records) // RECORD.size, len(names)))
+        f.write(_offsets(name_offsets))
+        f.write(blob)
+        f.write(_pad(f.tell(), OFFSET.size))
+        f.write(_offsets(group_offsets))
+        f.write(_pad(f.tell(), 8))
+        f.write(records)
+        # On disk before the rename, or a crash could leave a renamed but empty snapshot.
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return generation
+
+class Snapshot(Sequence):
+    '''Read-only view of a snapshot file, indexed like `List[List[Exercise]]`.
+
+    Groups are decoded from the mapping when accessed; only the exercise
+    names are read up front. The mapping stays valid after the file is
+    replaced, and is released with the last reference to the snapshot.
+    '''
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            try:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                # An empty file cannot be mapped.
+                raise SnapshotError(f"{path}: empty snapshot") from e
+        if len(self.buffer) < HEADER.size:
+            raise SnapshotError(f"{path}: truncated snapshot")
+        try:
+            self._read_header(path)
+        except (struct.error, UnicodeDecodeError) as e:
+            raise SnapshotError(f"{path}: truncated snapshot") from e
+
+    def _read_header(self, path: str):
+        magic, version, self.generation, last_time, groups, records, names = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise SnapshotError(f"{path}: not a snapshot")
+        if version != FORMAT_VERSION:
+            raise SnapshotError(f"{path}: unsupported snapshot version {version}")
+        self.last_time = datetime.fromtimestamp(last_time)
+
+        offset = HEADER.size
+        name_offsets = struct.unpack_from(f"<{names + 1}I", self.buffer, offset)
+        offset += OFFSET.size * (names + 1)
+        self.names = [self.buffer[offset + start:offset + end].decode()
+                      for start, end in zip(name_offsets, name_offsets[1:])]
+        offset += name_offsets[-1]
+        offset += -offset % OFFSET.size
+        self.group_offsets = struct.unpack_from(f"<{groups + 1}I", self.buffer, offset)
+        offset += OFFSET.size * (groups + 1)
+        self.records = offset + -offset % 8
+        if self.records + RECORD.size * records != len(self.buffer):
+            raise SnapshotError(f"{path}: truncated snapshot")
+
+    def __len__(self) -> int:
+        return len(self.group_offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = range(len(self))[i]
+        group = []
+        for record in range(self.group_offsets[i], self.group_offsets[i + 1]):
+            timestamp, name, unit, weight, reps, set_number = RECORD.unpack_from(self.buffer, self.records + RECORD.size * record)
+            group.append(Exercise(datetime.fromtimestamp(timestamp), self.names[name], UNITS[unit], weight, reps, set_number))
+        return group
+
+    def to_groups(self) -> List[List[Exercise]]:
+        return list(self)
@@ -0,0 +1,131 @@
+import os
+import pickle
+import shelve
+import sqlite3
+import threading
+from typing import Any, Callable, Tuple
+
+STATE_PATH = "state.db"
+# Pre-SQLite state next to state.db, imported once when state.db is created.
+SHELVE_PATH = "shelve.db"
+
+_MISSING = object()
+
+class StateStore:
+    '''Small key/value store shared by every module, process and thread.
+
+    Values are pickled into a WAL-mode SQLite table. Reads go through an
+    in-process cache that is dropped whenever another connection commits
+    (tracked with `pragma data_version`), so a hit costs one pragma call.
+    Writes that depend on the current value use `update`, which runs the
+    read-modify-write inside one `begin immediate` transaction.
+    '''
+
+    def __init__(self, path: str = STATE_PATH):
+        created = not os.path.exists(path)
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("pragma journal_mode=wal")
+        self.conn.execute("create table if not exists state (key text primary key, value blob not null)")
+        self.cache = {}
+        self.data_version = None
+        if created:
+            self.migrate_shelve(os.path.join(os.path.dirname(path), SHELVE_PATH))
+
+    def migrate_shelve(self, path: str = SHELVE_PATH):
+        try:
+            with shelve.open(path, "r") as db:
+                items = dict(db)
+        except Exception:
+            return
+        for key, value in items.items():
+            self.set(key, value)
+
+    def _sync(self):
+        version = self.conn.execute("pragma data_version").fetchone()[0]
+        if version != self.data_version:
+            self.cache.clear()
+            self.data_version = version
+
+    def _read(self, key: str):
+        row = self.conn.execute("select value from state where key = ?", (key,)).fetchone()
+        return _MISSING if row is None else pickle.loads(row[0])
+
+    def get(self, key: str, default=None):
+        with self.lock:
+            self._sync()
+            value = self.cache.get(key, _MISSING)
+            if value is _MISSING:
+                value = self.cache[key] = self._read(key)
+            return default if value is _MISSING else value
+
+    def set(self, key: str, value):
+        self.update(key, lambda _: value)
+
+    def delete(self, key: str):
+        with self.lock:
+            self.conn.execute("delete from state where key = ?", (key,))
+            self.cache.pop(key, None)
+
+    def update(self, key: str, fn: Callable[[Any], Any]) -> Tuple[Any, bool]:
+        '''Atomically replace the value of `key` with `fn(current)`.
+
+        `current` is None when the key is unset. If `fn` returns `_MISSING`
+        (see `compare_and_set`) nothing is written. Returns the stored value
+        and whether it was written.
+        '''
+        with self.lock:
+            self.conn.execute("begin immediate")
+            try:
+                current = self._read(key)
+                value = fn(None if current is _MISSING else current)
+                if value is not _MISSING:
+                    self.conn.execute("insert or replace into state (key, value) values (?, ?)",
+                                      (key, pickle.dumps(value)))
+                self.conn.execute("commit")
+            except BaseException:
+                self.conn.execute("rollback")
+                self.cache.pop(key, None)
+                raise
+            # Our own commit bumps no data_version, so the cache stays valid.
+            if value is not _MISSING:
+                self.cache[key] = value
+                return value, True
+            return None if current is _MISSING else current, False
+
+    def compare_and_set(self, key: str, expected, value) -> bool:
+        '''Set `key` to `value` only if it currently equals `expected`.'''
+        return self.update(key, lambda current: value if current == expected else _MISSING)[1]
+
+    def set_if_greater(self, key: str, value) -> bool:
+        '''Set `key` to `value` only if unset or `value` is greater, e.g. `last_time`.'''
+        return self.update(key, lambda current: value if current is None or value > current else _MISSING)[1]
+
+# One store per path: the shared state.db, plus one per tenant (see tenants.py).
+_stores = {}
+_store_lock = threading.Lock()
+
+def _reset_after_fork():
+    # SQLite connections must not be shared with forked children (gunicorn --preload).
+    _stores.clear()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def get_store(path: str = STATE_PATH) -> StateStore:
+    with _store_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = StateStore(path)
+        return store
+
+def get(key: str, default=None):
+    return get_store().get(key, default)
+
+def store(key: str, value):
+    get_store().set(key, value)
+
+def set_if_greater(key: str, value) -> bool:
+    return get_store().set_if_greater(key, value)
+
+def compare_and_set(key: str, expected, value) -> bool:
+    return get_store().compare_and_set(key, expected, value)
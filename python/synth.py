@@ -0,0 +1,136 @@
+'''Synthetic GymRun backups for benchmarks and local runs.
+
+Builds the `exercise`, `workout` and `entry` tables the way GymRun writes
+them (times in epoch seconds, weights in kilograms, set properties encoded
+as "3-set,4-weight,5-reps,52-extra reps" in `entry.data`) and optionally
+wraps the database in the AES-encrypted `gymapp.zip` of an automatic backup.
+
+    python synth.py gymapp.zip --size year
+    python synth.py gymapp.db --workouts 20 --seed 1
+'''
+import argparse
+import random
+import sqlite3
+from io import BytesIO
+
+import pyzipper
+
+from gymrun import ZIP_PASSWORD, lbs_to_kg
+
+# Workouts per preset, at roughly three and a half sessions a week.
+SIZES = {
+    "one": 1,
+    "week": 4,
+    "month": 15,
+    "year": 180,
+    "decade": 1800,
+}
+
+SCHEMA = """
+create table exercise (_id integer primary key, xlabel text, unit text, category integer);
+create table workout (_id integer primary key, time_start integer, time_end integer, note text);
+create table entry (_id integer primary key, time integer, exercise integer, workout integer, data text);
+create index entry_time on entry (time);
+"""
+
+# (name, GymRun unit: "1" kg, "2" lbs, None bodyweight, starting weight in that unit)
+EXERCISES = [
+    ("Bench Press", "1", 40),
+    ("Squat", "1", 50),
+    ("Deadlift", "1", 60),
+    ("Overhead Press", "1", 25),
+    ("Barbell Row", "1", 35),
+    ("Incline Dumbbell Press", "1", 14),
+    ("Romanian Deadlift", "1", 40),
+    ("Leg Press", "2", 180),
+    ("Lat Pulldown", "2", 80),
+    ("Seated Cable Row", "2", 70),
+    ("Leg Curl", "2", 50),
+    ("Cable Fly", "2", 25),
+    ("Pull Up", None, 0),
+    ("Dip", None, 0),
+    ("Push Up", None, 0),
+    ("Hanging Leg Raise", None, 0),
+]
+
+START_TIME = 1420070400  # 2015-01-01
+
+def encode_properties(set_number: int, weight: float | None, reps: int, extra_reps: int = 0) -> str:
+    '''Inverse of `gymrun.parse_properties`.'''
+    parts = [f"3-{set_number}"]
+    if weight is not None:
+        parts.append(f"4-{weight:g}")
+    parts.append(f"5-{reps}")
+    parts.append(f"52-{extra_reps}")
+    return ",".join(parts)
+
+def generate(workouts: int, seed: int = 0, start: int = START_TIME) -> bytes:
+    '''Return a serialized GymRun database holding `workouts` sessions.'''
+    rng = random.Random(seed)
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(SCHEMA)
+    conn.executemany("insert into exercise (_id, xlabel, unit, category) values (?, ?, ?, ?)",
+                     [(i + 1, name, unit, i % 5) for i, (name, unit, _) in enumerate(EXERCISES)])
+
+    # Each exercise progresses slowly and independently over the history.
+    weights = [float(weight) for _, _, weight in EXERCISES]
+    time = start
+    workout_rows, entry_rows = [], []
+    for workout_id in range(1, workouts + 1):
+        time += rng.choice((1, 2, 2, 3)) * 86400 + rng.randint(-7200, 7200)
+        time_start = time
+        t = time_start
+        for exercise in rng.sample(range(len(EXERCISES)), rng.randint(3, 6)):
+            _, unit, _ = EXERCISES[exercise]
+            if unit is not None and rng.random() < 0.3:
+                weights[exercise] += 2.5 if unit == "1" else 5
+            for set_number in range(1, rng.randint(3, 5) + 1):
+                t += rng.randint(90, 240)
+                reps = rng.randint(5, 12)
+                if unit is None:
+                    weight = None
+                elif unit == "2":
+                    weight = round(lbs_to_kg(weights[exercise]), 3)
+                else:
+                    weight = weights[exercise]
+                extra = rng.randint(1, 3) if rng.random() < 0.05 else 0
+                entry_rows.append((t, exercise + 1, workout_id, encode_properties(set_number, weight, reps, extra)))
+        workout_rows.append((workout_id, time_start, t + 60, None))
+        time = t
+    conn.executemany("insert into workout (_id, time_start, time_end, note) values (?, ?, ?, ?)", workout_rows)
+    conn.executemany("insert into entry (time, exercise, workout, data) values (?, ?, ?, ?)", entry_rows)
+    conn.commit()
+    data = bytearray(conn.serialize())
+    conn.close()
+    # A serialized in-memory database never bumps its change counter; set it
+    # as if the app had committed once per set, like a database on a phone.
+    counter = len(entry_rows).to_bytes(4, "big")
+    data[24:28] = data[92:96] = counter
+    return bytes(data)
+
+def wrap_zip(sqlite_file: bytes) -> bytes:
+    '''Encrypt a database into the `gymapp.zip` layout of a GymRun backup.'''
+    buffer = BytesIO()
+    with pyzipper.AESZipFile(buffer, "w", compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES) as zf:
+        zf.setpassword(ZIP_PASSWORD)
+        zf.writestr("gymapp.db", sqlite_file)
+    return buffer.getvalue()
+
+def generate_zip(workouts: int, seed: int = 0, start: int = START_TIME) -> bytes:
+    return wrap_zip(generate(workouts, seed, start))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic GymRun backup")
+    parser.add_argument("output", help="path ending in .zip for an encrypted backup, anything else for a bare database")
+    parser.add_argument("--size", choices=SIZES, default="year")
+    parser.add_argument("--workouts", type=int, help="number of workouts, overrides --size")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    workouts = args.workouts or SIZES[args.size]
+    data = generate(workouts, args.seed)
+    if args.output.endswith(".zip"):
+        data = wrap_zip(data)
+    with open(args.output, "wb") as f:
+        f.write(data)
+    print(f"{args.output}: {workouts} workouts, {len(data) / 1024:.0f} KiB")
@@ -0,0 +1,117 @@
+import hmac
+import json
+import os
+import re
+import secrets
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import state
+
+# Each tenant keeps its state, history, token cache and cards in its own
+# directory. The default tenant is the working directory itself, so a
+# single-user deployment keeps its existing layout and URLs.
+TENANTS_DIR = "tenants"
+DEFAULT_TENANT = "default"
+# Optional per-tenant settings inside the tenant directory, e.g.
+# {"zip_path": "/Apps/GymRun/gymapp.zip", "post_targets": ["mastodon_alice"]}.
+TENANT_CONFIG = "tenant.json"
+# Where backups come from unless tenant.json says otherwise: "onedrive" or "drive".
+BACKUP_SOURCE = os.environ.get("BACKUP_SOURCE", "onedrive")
+TENANT_NAME = re.compile(r"[a-z0-9][a-z0-9_-]{0,62}")
+# First path segments the app already uses.
+RESERVED_NAMES = {"account", "analytics", "card.png", "card.svg", "cards", "metrics", "queue", "resubscribe", "static", "webhook"}
+
+@dataclass(frozen=True)
+class Tenant:
+    name: str
+    root: str
+    # None means the deployment-wide default (onedrive.ZIP_PATH, post.POST_TARGETS).
+    zip_path: Optional[str] = None
+    post_targets: Optional[Tuple[str, ...]] = None
+    source: str = BACKUP_SOURCE
+
+    def path(self, name: str) -> str:
+        return os.path.normpath(os.path.join(self.root, name))
+
+    def state(self) -> state.StateStore:
+        return state.get_store(self.path(state.STATE_PATH))
+
+_tenants: Dict[str, Tenant] = {}
+_tenants_lock = threading.Lock()
+
+def load_tenant(name: str) -> Optional[Tenant]:
+    if name == DEFAULT_TENANT:
+        root = "."
+    elif TENANT_NAME.fullmatch(name) and name not in RESERVED_NAMES:
+        root = os.path.join(TENANTS_DIR, name)
+        if not os.path.isdir(root):
+            return None
+    else:
+        return None
+    try:
+        with open(os.path.join(root, TENANT_CONFIG)) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        config = {}
+    targets = config.get("post_targets")
+    return Tenant(name, root, config.get("zip_path"), None if targets is None else tuple(targets),
+                  config.get("source", BACKUP_SOURCE))
+
+def get_tenant(name: str = DEFAULT_TENANT) -> Optional[Tenant]:
+    '''The tenant called `name`, or None if there is no such tenant directory.'''
+    with _tenants_lock:
+        tenant = _tenants.get(name)
+        if tenant is None:
+            tenant = load_tenant(name)
+            if tenant is not None:
+                _tenants[name] = tenant
+        return tenant
+
+def list_tenants() -> List[Tenant]:
+    names = sorted(entry.name for entry in os.scandir(TENANTS_DIR) if entry.is_dir()) if os.path.isdir(TENANTS_DIR) else []
+    return [get_tenant(DEFAULT_TENANT)] + [t for t in map(get_tenant, names) if t is not None]
+
+def subscription_key(subscription_id: str) -> str:
+    return f"subscription:{subscription_id}"
+
+def client_state(tenant: Tenant) -> str:
+    '''Secret sent as the clientState of the tenant's subscriptions.
+
+    Graph echoes it in every notification, so `tenant_for_notification` can
+    tell real notifications from forged ones. Created on first use.
+    '''
+    store = tenant.state()
+    store.compare_and_set("client_state", None, secrets.token_urlsafe(32))
+    return store.get("client_state")
+
+def register_subscription_tenant(subscription_id: str, tenant: Tenant, secret: str):
+    # Kept in the shared store: notifications arrive before we know the tenant.
+    state.store(subscription_key(subscription_id), {"tenant": tenant.name, "client_state": secret})
+
+def tenant_for_notification(notification: dict) -> Optional[Tenant]:
+    '''Tenant owning a change notification, or None if its subscription is
+    unknown or its clientState does not match the one registered.'''
+    subscription_id = notification.get("subscriptionId")
+    registered = state.get(subscription_key(subscription_id)) if subscription_id else None
+    # Subscriptions registered before clientState secrets map to a bare
+    # tenant name; they are dropped until the tenant resubscribes.
+    if not isinstance(registered, dict) or not matches(notification.get("clientState"), registered["client_state"]):
+        return None
+    return get_tenant(registered["tenant"])
+
+def channel_token(tenant: Tenant) -> str:
+    '''Token of the tenant's Drive channel, echoed in X-Goog-Channel-Token.'''
+    return f"{tenant.name}:{client_state(tenant)}"
+
+def tenant_for_channel(token: Optional[str]) -> Optional[Tenant]:
+    '''Tenant owning a Drive notification, or None if its token is not one from `channel_token`.'''
+    name, _, secret = (token or "").partition(":")
+    tenant = get_tenant(name) if name else None
+    if tenant is None or not matches(secret, tenant.state().get("client_state")):
+        return None
+    return tenant
+
+def matches(value: Optional[str], secret: Optional[str]) -> bool:
+    return bool(value) and bool(secret) and hmac.compare_digest(str(value), secret)
@@ -0,0 +1,94 @@
+import sqlite3
+
+import pytest
+
+from gymrun import parse_properties
+import history
+import synth
+
+def edit(sqlite_file: bytes, *statements) -> bytes:
+    '''A copy of a backup with `(sql, params)` statements run against it, as the app would change it.'''
+    conn = sqlite3.connect(":memory:")
+    conn.deserialize(sqlite_file)
+    for sql, params in statements:
+        conn.execute(sql, params)
+    conn.commit()
+    data = conn.serialize()
+    conn.close()
+    return data
+
+def backup_entries(sqlite_file: bytes) -> list:
+    conn = sqlite3.connect(":memory:")
+    conn.deserialize(sqlite_file)
+    rows = conn.execute("select _id, time, data from entry order by time, _id").fetchall()
+    conn.close()
+    return [(entry_id, time, *parse_properties(data)) for entry_id, time, data in rows]
+
+def stored_entries(path) -> list:
+    conn = history.connect_readonly(path)
+    try:
+        return conn.execute("select _id, time, set_number, weight, reps from entry order by time, _id").fetchall()
+    finally:
+        conn.close()
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "history.db")
+
+def test_first_backup_stores_every_entry(path):
+    backup = synth.generate(5)
+    assert history.update_history(backup, path) == len(backup_entries(backup))
+    assert stored_entries(path) == backup_entries(backup)
+    with sqlite3.connect(path) as conn:
+        assert history.high_water_mark(conn) == tuple(backup_entries(backup)[-1][1::-1])
+
+def test_later_backup_appends_only_new_entries(path):
+    # Same seed, so the longer backup starts with the shorter one's workouts.
+    older, newer = synth.generate(3), synth.generate(6)
+    history.update_history(older, path)
+    added = history.update_history(newer, path)
+    assert added == len(backup_entries(newer)) - len(backup_entries(older))
+    assert stored_entries(path) == backup_entries(newer)
+
+def test_same_backup_again_adds_nothing(path):
+    backup = synth.generate(4)
+    history.update_history(backup, path)
+    with sqlite3.connect(path) as conn:
+        hwm = history.high_water_mark(conn)
+    assert history.update_history(backup, path) == 0
+    assert stored_entries(path) == backup_entries(backup)
+    with sqlite3.connect(path) as conn:
+        assert history.high_water_mark(conn) == hwm
+
+def test_entry_at_the_high_water_mark_time_with_a_later_id_is_added(path):
+    backup = synth.generate(2)
+    history.update_history(backup, path)
+    last_id, last_time = backup_entries(backup)[-1][:2]
+    backup = edit(backup, ("insert into entry (_id, time, exercise, workout, data) values (?, ?, 1, 2, '3-9,4-50,5-5')",
+                           (last_id + 1, last_time)))
+    assert history.update_history(backup, path) == 1
+    assert stored_entries(path)[-1] == (last_id + 1, last_time, 9, 50.0, 5)
+
+def test_edits_below_the_high_water_mark_are_not_reread(path):
+    # Only the delta is parsed; backfill.py is what merges edited entries.
+    backup = synth.generate(2)
+    history.update_history(backup, path)
+    first_id, first_time = backup_entries(backup)[0][:2]
+    edited = edit(backup,
+                  ("update entry set data = '3-1,4-999,5-1' where _id = ?", (first_id,)),
+                  ("insert into entry (_id, time, exercise, workout, data) values (1000, ?, 1, 1, '3-9,4-50,5-5')", (first_time,)))
+    assert history.update_history(edited, path) == 0
+    assert stored_entries(path) == backup_entries(backup)
+
+def test_workouts_are_linked_and_grouped(path):
+    backup = synth.generate(2)
+    history.update_history(backup, path)
+    conn = history.connect_readonly(path)
+    try:
+        workout = history.find_workout(conn, 2)
+        sets, last_time = history.workout_version(conn, workout)
+        groups = history.workout_sets(conn, workout)
+    finally:
+        conn.close()
+    assert sets == sum(len(group) for group in groups)
+    assert last_time == backup_entries(backup)[-1][1]
@@ -0,0 +1,90 @@
+import threading
+import time
+from contextlib import closing
+
+import pytest
+
+import jobs
+
+@pytest.fixture
+def queue(tmp_path):
+    return jobs.JobQueue(str(tmp_path / "jobs.db"), workers=0, tenant_concurrency=1)
+
+@pytest.fixture
+def conn(queue):
+    with closing(queue.connect()) as conn:
+        yield conn
+
+def claim_key(queue, conn):
+    row = queue.claim(conn)
+    return None if row is None else row[1]
+
+def finish(queue, conn, key):
+    queue.release(conn.execute("select id from job where key = ? and status = 'running'", (key,)).fetchone()[0])
+    conn.execute("update job set status = 'done', finished = ? where key = ? and status = 'running'", (time.time(), key))
+
+def test_tenant_with_fewer_running_jobs_goes_first(queue, conn):
+    queue.tenant_concurrency = 2
+    for key in ("process:alice", "post:alice", "refresh:alice", "process:bob"):
+        queue.enqueue(key, debounce=0)
+    # bob's job is the newest but alice already has one running.
+    assert claim_key(queue, conn) == "process:alice"
+    assert claim_key(queue, conn) == "process:bob"
+    assert claim_key(queue, conn) == "post:alice"
+
+def test_least_recently_served_tenant_goes_first(queue, conn):
+    queue.enqueue("process:bob", debounce=0)
+    assert claim_key(queue, conn) == "process:bob"
+    finish(queue, conn, "process:bob")
+    # bob's job is older, but bob was served and alice was not.
+    queue.enqueue("post:bob", debounce=0)
+    queue.enqueue("process:alice", debounce=0)
+    assert claim_key(queue, conn) == "process:alice"
+    assert claim_key(queue, conn) == "post:bob"
+
+def test_tenant_concurrency_caps_running_jobs(queue, conn):
+    for key in ("process:alice", "post:alice", "refresh:alice"):
+        queue.enqueue(key, debounce=0)
+    assert claim_key(queue, conn) == "process:alice"
+    assert claim_key(queue, conn) is None
+    queue.enqueue("process:bob", debounce=0)
+    assert claim_key(queue, conn) == "process:bob"
+    finish(queue, conn, "process:alice")
+    assert claim_key(queue, conn) == "post:alice"
+
+def test_one_running_job_per_key(queue, conn):
+    queue.tenant_concurrency = 2
+    queue.enqueue("process:alice", debounce=0)
+    assert claim_key(queue, conn) == "process:alice"
+    queue.enqueue("process:alice", debounce=0)
+    assert claim_key(queue, conn) is None
+    finish(queue, conn, "process:alice")
+    assert claim_key(queue, conn) == "process:alice"
+
+def test_expired_lease_is_reclaimed(queue, conn, monkeypatch):
+    monkeypatch.setattr(jobs, "LEASE", 0.05)
+    job_id = queue.enqueue("process:alice", debounce=0)
+    assert claim_key(queue, conn) == "process:alice"
+    # Its process died: the lease is never renewed.
+    queue.release(job_id)
+    time.sleep(0.1)
+    assert claim_key(queue, conn) == "process:alice"
+    assert conn.execute("select attempts, error from job where id = ?", (job_id,)).fetchone() == (1, "lease expired")
+
+def test_expired_lease_fails_the_job_after_max_attempts(queue, conn, monkeypatch):
+    monkeypatch.setattr(jobs, "LEASE", 0.01)
+    job_id = queue.enqueue("process:alice", debounce=0)
+    for _ in range(jobs.MAX_ATTEMPTS):
+        assert claim_key(queue, conn) == "process:alice"
+        time.sleep(0.02)
+    assert claim_key(queue, conn) is None
+    assert conn.execute("select status, attempts from job where id = ?", (job_id,)).fetchone() == ("failed", jobs.MAX_ATTEMPTS)
+
+def test_heartbeat_keeps_the_lease(queue, conn, monkeypatch):
+    monkeypatch.setattr(jobs, "LEASE", 0.2)
+    threading.Thread(target=queue.heartbeat, daemon=True).start()
+    job_id = queue.enqueue("process:alice", debounce=0)
+    assert claim_key(queue, conn) == "process:alice"
+    time.sleep(0.5)
+    assert claim_key(queue, conn) is None
+    assert conn.execute("select status, attempts from job where id = ?", (job_id,)).fetchone() == ("running", 0)
@@ -0,0 +1,80 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import state
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "state.db")
+
+@pytest.fixture
+def store(path):
+    return state.StateStore(path)
+
+def test_compare_and_set_writes_on_match(store):
+    store.set("zip_version", "a")
+    assert store.compare_and_set("zip_version", "a", "b")
+    assert store.get("zip_version") == "b"
+
+def test_compare_and_set_fails_on_mismatch(store, path):
+    store.set("zip_version", "a")
+    assert not store.compare_and_set("zip_version", "stale", "b")
+    assert store.get("zip_version") == "a"
+    assert state.StateStore(path).get("zip_version") == "a"
+
+def test_compare_and_set_unset_key_matches_none(store):
+    assert store.compare_and_set("client_state", None, "secret")
+    assert not store.compare_and_set("client_state", None, "other")
+    assert store.get("client_state") == "secret"
+
+def test_set_if_greater(store):
+    assert store.set_if_greater("last_time", 10)
+    assert store.set_if_greater("last_time", 20)
+    assert not store.set_if_greater("last_time", 15)
+    assert not store.set_if_greater("last_time", 20)
+    assert store.get("last_time") == 20
+
+def test_update_reports_the_stored_value(store):
+    assert store.update("count", lambda current: (current or 0) + 1) == (1, True)
+    assert store.update("count", lambda current: state._MISSING) == (1, False)
+
+def test_concurrent_compare_and_set_has_one_winner(path):
+    # Separate stores, so separate connections racing on the same row.
+    stores = [state.StateStore(path) for _ in range(8)]
+    barrier = threading.Barrier(len(stores))
+    won = []
+
+    def claim(i):
+        barrier.wait()
+        if stores[i].compare_and_set("posted", None, i):
+            won.append(i)
+
+    threads = [threading.Thread(target=claim, args=(i,)) for i in range(len(stores))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(won) == 1
+    assert stores[0].get("posted") == won[0]
+
+def test_other_connection_invalidates_cache(path):
+    reader, writer = state.StateStore(path), state.StateStore(path)
+    writer.set("last_time", 1)
+    assert reader.get("last_time") == 1
+    writer.set("last_time", 2)
+    assert reader.get("last_time") == 2
+    writer.delete("last_time")
+    assert reader.get("last_time") is None
+
+def test_other_process_invalidates_cache(path):
+    store = state.StateStore(path)
+    store.set("last_time", 1)
+    assert store.get("last_time") == 1
+    subprocess.run([sys.executable, "-c", "import sys, state; state.StateStore(sys.argv[1]).set_if_greater('last_time', 5)", path],
+                   check=True, cwd=os.path.dirname(state.__file__))
+    assert store.get("last_time") == 5
+    assert not store.set_if_greater("last_time", 3)